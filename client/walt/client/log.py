@@ -1,7 +1,11 @@
-import sys, re, datetime, pickle
+import os, sys, re, datetime, pickle
+from collections import deque
+from time import time
 from walt.common.constants import WALT_SERVER_TCP_PORT
 from walt.common.tcp import read_pickle, write_pickle, client_sock_file, \
-                            Requests
+                            read_log_records_frame, Requests, LOGS_DUMP_ACK, \
+                            LOGS_WAIT_COMPLETED, LOGS_WAIT_TIMEOUT, \
+                            LOGS_HISTORY_COMPLETED
 from plumbum import cli
 from walt.client.application import WalTCategoryApplication, WalTApplication
 from walt.client.config import conf
@@ -26,15 +30,182 @@ def validate_checkpoint_name(name):
 
 class LogsFlowFromServer(object):
     def __init__(self, walt_server_host):
-        self.f = client_sock_file(walt_server_host, WALT_SERVER_TCP_PORT)
+        self.server_host = walt_server_host
+        self.f = None
+        self.records = deque()
+        self.batched = False
+    def connect(self, req_id):
+        self.f = client_sock_file(self.server_host, WALT_SERVER_TCP_PORT)
+        Requests.send_id(self.f, req_id)
     def read_log_record(self):
-        return read_pickle(self.f)
+        if not self.batched:
+            return read_pickle(self.f)
+        # records are received in batches
+        while len(self.records) == 0:
+            records = read_log_records_frame(self.f)
+            if records is None:
+                return None
+            self.records.extend(records)
+        return self.records.popleft()
+    # return False if the server is too old to handle this request
+    # (see LOGS_DUMP_ACK); request_legacy_log_dump() should be used then.
     def request_log_dump(self, **kwargs):
-        Requests.send_id(self.f, Requests.REQ_DUMP_LOGS)
-        write_pickle(kwargs, self.f)
+        self.connect(Requests.REQ_DUMP_LOGS_BATCHED)
+        try:
+            ack = self.f.readline()
+        except OSError:
+            ack = None
+        if ack != LOGS_DUMP_ACK:
+            self.f.close()
+            return False
+        self.batched = True
+        write_pickle(dict(batched = True, **kwargs), self.f)
+        return True
+    def request_legacy_log_dump(self, history, realtime, senders, streams,
+                                logline_regexp):
+        self.connect(Requests.REQ_DUMP_LOGS)
+        write_pickle(dict(history = history, realtime = realtime,
+                          senders = senders, streams = streams,
+                          logline_regexp = logline_regexp), self.f)
+    def set_timeout(self, timeout):
+        self.f.sock.settimeout(timeout)
     def close(self):
         self.f.close()
 
+# Older servers do not handle parameters wait, resume and history_status.
+# With such a server, this class emulates them on client side, and
+# returns the same status records a newer server would send.
+class LegacyLogsDump(object):
+    def __init__(self, conn, params, wait, export):
+        self.conn = conn
+        self.realtime = params['realtime']
+        self.status = None
+        self.eof = False
+        self.deadline = None
+        self.missing_senders = None
+        if wait is not None:
+            if wait['timeout']:
+                self.deadline = time() + wait['timeout']
+            if wait['mode'] == 'ALL':
+                self.missing_senders = set(params['senders'])
+        self.wait = wait
+        # when resuming an export, skip records already exported
+        self.resume_timestamp, self.resume_skip = None, 0
+        if export is not None and export.position is not None:
+            self.resume_timestamp, self.resume_skip = export.position
+            end = params['history'][1] if params['history'] else None
+            # (timestamps have a precision of one microsecond)
+            start = self.resume_timestamp - datetime.timedelta(microseconds = 1)
+            params = dict(params, history = (pickle.dumps(start), end))
+        conn.request_legacy_log_dump(**params)
+    def read_log_record(self):
+        if self.status is not None:
+            status, self.status = self.status, None
+            return dict(status = status)
+        while True:
+            if self.deadline is not None:
+                remaining = self.deadline - time()
+                if remaining <= 0:
+                    return dict(status = LOGS_WAIT_TIMEOUT)
+                self.conn.set_timeout(remaining)
+            if self.eof:
+                return None
+            record = self.conn.read_log_record()
+            if record is None:
+                self.eof = True
+                if self.deadline is not None and time() >= self.deadline:
+                    return dict(status = LOGS_WAIT_TIMEOUT)
+                if not self.realtime:
+                    # (the server closes the connection after the history)
+                    return dict(status = LOGS_HISTORY_COMPLETED)
+                return None
+            if self.resume_skip > 0 and record['timestamp'] == self.resume_timestamp:
+                self.resume_skip -= 1
+                continue
+            self.resume_skip = 0
+            if self.wait is not None:
+                if self.missing_senders is not None:
+                    self.missing_senders.discard(record['sender'])
+                if self.missing_senders is None or len(self.missing_senders) == 0:
+                    self.status = LOGS_WAIT_COMPLETED
+            return record
+
+# Logs may be exported to a file. While the export runs, a resume marker
+# (file <export-file>.resume) records the query and the position of the
+# last record written, in order to resume the export if it is
+# interrupted. The marker is removed when the export is complete.
+EXPORT_MARKER_SUFFIX = '.resume'
+EXPORT_MARKER_PERIOD = 1.0
+
+class LogsExport(object):
+    def __init__(self, path, options):
+        self.path = path
+        self.marker_path = path + EXPORT_MARKER_SUFFIX
+        self.options = options
+        self.f = None
+        self.senders, self.history = None, None
+        # (timestamp of the last record, number of records with this timestamp)
+        self.position = None
+        self.resuming = False
+        self.marker_time = 0
+    # return False if the export cannot be started
+    def load_marker(self):
+        if not os.path.exists(self.marker_path) or not os.path.exists(self.path):
+            return True
+        with open(self.marker_path, 'rb') as f:
+            marker = pickle.load(f)
+        if marker['options'] != self.options:
+            print('An export to %s was interrupted, with different options.' % self.path)
+            print('Use the same options to resume it, or remove %s.' % self.marker_path)
+            return False
+        self.senders, self.history = marker['senders'], marker['history']
+        self.position = marker['position']
+        self.f = open(self.path, 'r+', encoding = 'utf-8')
+        # discard lines written after the marker was saved
+        self.f.truncate(marker['size'])
+        self.f.seek(marker['size'])
+        self.resuming = True
+        print('Resuming the interrupted export to %s.' % self.path)
+        return True
+    def start(self, senders, history):
+        self.senders, self.history = senders, history
+        self.f = open(self.path, 'w', encoding = 'utf-8')
+        self.save_marker()
+    def get_request_params(self):
+        params = dict(history_status = True)
+        if self.position is not None:
+            timestamp, count = self.position
+            params.update(resume = (pickle.dumps(timestamp), count))
+        return params
+    def write(self, line, timestamp):
+        self.f.write(line + '\n')
+        if self.position is not None and self.position[0] == timestamp:
+            self.position = (timestamp, self.position[1] + 1)
+        else:
+            self.position = (timestamp, 1)
+        if time() - self.marker_time > EXPORT_MARKER_PERIOD:
+            self.save_marker()
+    def save_marker(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        marker = dict(options = self.options, senders = self.senders,
+                      history = self.history, position = self.position,
+                      size = self.f.tell())
+        tmp_path = self.marker_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(marker, f)
+        os.replace(tmp_path, self.marker_path)
+        self.marker_time = time()
+    def close(self, completed):
+        if completed:
+            self.f.close()
+            os.remove(self.marker_path)
+        else:
+            self.save_marker()
+            self.f.close()
+            print('Export to %s interrupted, run the same command again to resume it.' % \
+                    self.path)
+
 class WalTLog(WalTCategoryApplication):
     """management of logs"""
     pass
@@ -109,24 +280,44 @@ class WalTLogShowOrWait(WalTApplication):
                 return False
         return True
 
+    # if wait is specified, the server evaluates the wait condition
+    # and ends the stream with a status.
+    # we return False if the wait timed out, True otherwise.
+    # if export is specified, records are written to the export file
+    # (see LogsExport).
     @staticmethod
     def start_streaming(format_string, history_range, realtime, senders, streams,
-                        logline_regexp, stop_test):
+                        logline_regexp, wait = None, export = None):
         conn = LogsFlowFromServer(conf['server'])
-        conn.request_log_dump(  history = history_range,
-                                realtime = realtime,
-                                senders = senders,
-                                streams = streams,
-                                logline_regexp = logline_regexp)
+        params = dict(  history = history_range,
+                        realtime = realtime,
+                        senders = senders,
+                        streams = streams,
+                        logline_regexp = logline_regexp)
+        export_params = {} if export is None else export.get_request_params()
+        if conn.request_log_dump(wait = wait, **params, **export_params):
+            flow = conn
+        else:
+            flow = LegacyLogsDump(conn, params, wait, export)
+        history_completed = False
         while True:
             try:
-                record = conn.read_log_record()
+                record = flow.read_log_record()
                 if record == None:
                     break
-                print(format_string.format(**record))
-                sys.stdout.flush()
-                if stop_test is not None and stop_test(**record):
+                if 'status' in record:
+                    if record['status'] == LOGS_HISTORY_COMPLETED:
+                        history_completed = True
+                        continue
+                    if record['status'] == LOGS_WAIT_TIMEOUT:
+                        print('Timeout.')
+                        return False
                     break
+                if export is None:
+                    print(format_string.format(**record))
+                    sys.stdout.flush()
+                else:
+                    export.write(format_string.format(**record), record['timestamp'])
             except KeyboardInterrupt:
                 print()
                 break
@@ -134,6 +325,9 @@ class WalTLogShowOrWait(WalTApplication):
                 print('Could not display the log record.')
                 print('Verify your format string.')
                 break
+        if export is not None:
+            export.close(history_completed and not realtime)
+        return True
 
 @WalTLog.subcommand("show")
 class WalTLogShow(WalTLogShowOrWait):
@@ -148,6 +342,12 @@ class WalTLogShow(WalTLogShowOrWait):
                 argname = 'HISTORY_RANGE',
                 default = 'none',
                 help= """history range to be retrieved (see walt help show log-history)""")
+    export_path = cli.SwitchAttr(
+                "--export",
+                str,
+                argname = 'FILE',
+                default = None,
+                help= """write logs to FILE, with a resume marker (see walt help show log-history)""")
 
     def main(self, logline_regexp = None):
         if self.realtime == False and self.history_range == 'none':
@@ -156,26 +356,48 @@ class WalTLogShow(WalTLogShowOrWait):
             return
         if not WalTLogShowOrWait.verify_regexps(self.streams, logline_regexp):
             return
-        with ClientToServerLink() as server:
-            senders = server.parse_set_of_nodes(self.set_of_nodes)
-            if senders == None:
-                return
-            range_analysis = WalTLogShowOrWait.analyse_history_range(server, self.history_range)
-            if not range_analysis[0]:
-                print('''Invalid HISTORY_RANGE. See 'walt help show log-history' for more info.''')
+        export = None
+        if self.export_path is not None:
+            export = LogsExport(self.export_path, dict(
+                                    format = self.format_string,
+                                    nodes = self.set_of_nodes,
+                                    streams = self.streams,
+                                    realtime = self.realtime,
+                                    history = self.history_range,
+                                    logline_regexp = logline_regexp))
+            if not export.load_marker():
                 return
-            history_range = range_analysis[1]
-            # Note : if a regular expression is specified, we do not bother computing the number
-            # of log records, because this computation would be too expensive, and the number of
-            # matching lines is probably low.
-            if history_range and logline_regexp is None and isatty():
-                num_logs = server.count_logs(history = history_range, senders = senders, streams = self.streams)
-                if num_logs > NUM_LOGS_CONFIRM_TRESHOLD:
-                    print('This will display approximately %d log records from history.' % num_logs)
-                    if not confirm():
-                        return
+        if export is not None and export.resuming:
+            # same senders and history range as the interrupted export
+            senders, history_range = export.senders, export.history
+        else:
+            with ClientToServerLink() as server:
+                senders = server.parse_set_of_nodes(self.set_of_nodes)
+                if senders == None:
+                    return
+                range_analysis = WalTLogShowOrWait.analyse_history_range(server, self.history_range)
+                if not range_analysis[0]:
+                    print('''Invalid HISTORY_RANGE. See 'walt help show log-history' for more info.''')
+                    return
+                history_range = range_analysis[1]
+                # Note : if a regular expression is specified, we do not bother computing the number
+                # of log records, because this computation would be too expensive, and the number of
+                # matching lines is probably low.
+                if history_range and logline_regexp is None and isatty():
+                    num_logs = server.count_logs(history = history_range, senders = senders, streams = self.streams)
+                    if num_logs > NUM_LOGS_CONFIRM_TRESHOLD:
+                        print('This will display approximately %d log records from history.' % num_logs)
+                        if not confirm():
+                            return
+                if export is not None:
+                    if history_range and history_range[1] is None and not self.realtime:
+                        # on resume, do not export logs newer than now
+                        history_range = (history_range[0],
+                                         server.get_pickled_time())
+                    export.start(senders, history_range)
         WalTLogShowOrWait.start_streaming(self.format_string, history_range, self.realtime,
-                                            senders, self.streams, logline_regexp, None)
+                                            senders, self.streams, logline_regexp,
+                                            export = export)
 
 @WalTLog.subcommand("add-checkpoint")
 class WalTLogAddCheckpoint(WalTApplication):
@@ -231,6 +453,12 @@ class WalTLogWait(WalTLogShowOrWait):
                 argname = 'SECONDS',
                 default = 0,
                 help= """also look in recent past logs if they matched""")
+    timeout = cli.SwitchAttr(
+                "--timeout",
+                int,
+                argname = 'SECONDS',
+                default = 0,
+                help= """wait at most this number of seconds (0 means no limit)""")
 
     def main(self, logline_regexp):
         if not WalTLogShowOrWait.verify_regexps(self.streams, logline_regexp):
@@ -245,18 +473,9 @@ class WalTLogWait(WalTLogShowOrWait):
                 history_range = range_analysis[1]
             else:
                 history_range = None
-        if self.mode == 'ANY':
-            # as soon as a logline matches, we stop
-            def stop_test(**record):
-                return True
-        else:
-            # we stop when all nodes have emitted a matching logline
-            missing_senders = set(senders)
-            def stop_test(**record):
-                missing_senders.discard(record['sender'])
-                if len(missing_senders) == 0:
-                    return True     # yes, we should stop
-                else:
-                    return False    # no, we are not done yet
-        WalTLogShowOrWait.start_streaming(self.format_string, history_range, True,
-                                    senders, self.streams, logline_regexp, stop_test)
+        # the server will stop as soon as a logline matches (mode ANY),
+        # or when all nodes have emitted a matching logline (mode ALL).
+        wait = dict(mode = self.mode.upper(), timeout = self.timeout)
+        if not WalTLogShowOrWait.start_streaming(self.format_string, history_range, True,
+                                    senders, self.streams, logline_regexp, wait):
+            return 1
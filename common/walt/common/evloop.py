@@ -1,21 +1,30 @@
 #!/usr/bin/env python
 import os, sys
-from select import poll, select, POLLIN, POLLPRI
+from select import poll, select, POLLIN, POLLPRI, POLLOUT
 from time import time
 from heapq import heappush, heappop
+from itertools import count
 
 POLL_OPS_READ = POLLIN | POLLPRI
+POLL_OPS_WRITE = POLLOUT
 
 def is_read_event_ok(ev):
     # check that there is something to read
     # (i.e. POLLIN or POLLPRI)
     return (ev & (POLL_OPS_READ) > 0)
 
+def is_write_event_ok(ev):
+    # check that we can write
+    return (ev & (POLL_OPS_WRITE) > 0)
+
 # EventLoop allows to monitor incoming data on a set of
 # file descriptors, and call the appropriate listener when 
 # input data is detected.
 # Any number of listeners may be added, by calling 
 # register_listener().
+# Listeners registered (or updated) with POLL_OPS_WRITE in
+# their events must provide a method handle_write_event(), which
+# will be called when their file descriptor is writable.
 # In case of error, the file descriptor is removed from 
 # the set of watched descriptors.
 # When the set is empty, the loop stops.
@@ -24,17 +33,21 @@ class EventLoop(object):
     def __init__(self):
         self.listeners = {}
         self.planned_events = []
+        # events planned at the same time are processed in order
+        # (and targets are never compared)
+        self.planned_counter = count()
         self.poller = poll()
 
     def plan_event(self, ts, target, repeat_delay = None, **kwargs):
         heappush(self.planned_events,
-                 (ts, target, repeat_delay, kwargs))
+                 (ts, next(self.planned_counter), target, repeat_delay, kwargs))
 
     def get_timeout(self):
         if len(self.planned_events) == 0:
             return None
         else:
-            return (self.planned_events[0][0] - time())*1000
+            # a negative timeout would block poll() indefinitely
+            return max(0, (self.planned_events[0][0] - time())*1000)
 
     def update_listener(self, listener, events=POLL_OPS_READ):
         fd = listener.fileno()
@@ -69,7 +82,7 @@ class EventLoop(object):
             now = time()
             while len(self.planned_events) > 0 and \
                         self.planned_events[0][0] <= now:
-                ts, target, repeat_delay, kwargs = \
+                ts, _, target, repeat_delay, kwargs = \
                                     heappop(self.planned_events)
                 target.handle_planned_event(**kwargs)
                 if repeat_delay:
@@ -104,8 +117,11 @@ class EventLoop(object):
             fd, ev = res[0]
             listener = self.listeners[fd]
             # if error, we will remove the listener below
-            should_close = not is_read_event_ok(ev)
-            if not should_close:
+            should_close = not (is_read_event_ok(ev) or is_write_event_ok(ev))
+            if not should_close and is_write_event_ok(ev):
+                res = listener.handle_write_event(ts)
+                should_close = (res == False)
+            if not should_close and is_read_event_ok(ev):
                 # no error, let the listener
                 # handle the event
                 res = listener.handle_event(ts)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os, sys, socket
 from select import select
+from walt.common.tools import set_non_blocking
 
 # This function allows to disable buffering
 # of a file.
@@ -66,6 +67,74 @@ class SmartFile(object):
     def __del__(self):
         self.close()
 
+# LineReader (resp. FrameReader) objects allow to read all complete
+# lines (resp. frames) available on a file descriptor, without blocking.
+# In order to let other file descriptors be processed, at most
+# max_read_size bytes are read on each call to read_lines() (resp.
+# read_frames()); remaining data will be read on next call.
+class NonBlockingReader(object):
+    READ_SIZE = 1024 * 64
+    def __init__(self, f, max_read_size = READ_SIZE * 4):
+        self.fd = f.fileno()
+        self.max_read_size = max_read_size
+        self.partial = b''
+        self.eof = False
+        set_non_blocking(self.fd)
+    # return pending partial data followed by what is available
+    def read_data(self):
+        chunks = [ self.partial ]
+        size = 0
+        while size < self.max_read_size:
+            try:
+                chunk = os.read(self.fd, NonBlockingReader.READ_SIZE)
+            except BlockingIOError:
+                break   # nothing more for now
+            except OSError:
+                # e.g. connection reset by peer: handle it as an EOF
+                self.eof = True
+                break
+            if chunk == b'':
+                self.eof = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if len(chunk) < NonBlockingReader.READ_SIZE:
+                break   # we probably read everything
+        return b''.join(chunks)
+
+class LineReader(NonBlockingReader):
+    def read_lines(self):
+        lines = self.read_data().split(b'\n')
+        # last item is the beginning of a line not terminated yet
+        self.partial = lines.pop()
+        return lines
+
+# Reads frames starting with their length, encoded with
+# the given header (a struct.Struct with a single field).
+# If max_frame_size is specified, a larger frame raises ValueError
+# (otherwise a malformed or hostile peer could make us buffer
+# gigabytes while waiting for the end of the frame).
+class FrameReader(NonBlockingReader):
+    def __init__(self, f, header, max_frame_size = None, **kwargs):
+        NonBlockingReader.__init__(self, f, **kwargs)
+        self.header = header
+        self.max_frame_size = max_frame_size
+    def read_frames(self):
+        data = self.read_data()
+        frames, pos = [], 0
+        while len(data) - pos >= self.header.size:
+            length, = self.header.unpack_from(data, pos)
+            if self.max_frame_size is not None and \
+                    length > self.max_frame_size:
+                raise ValueError('Frame too large (%d bytes).' % length)
+            end = pos + self.header.size + length
+            if end > len(data):
+                break   # frame not complete yet
+            frames.append(data[pos + self.header.size:end])
+            pos = end
+        self.partial = data[pos:]
+        return frames
+
 # Copy what's available from a SmartFile
 # to an output stream
 def read_and_copy(in_reader, out):
@@ -1,4 +1,5 @@
-import socket, pickle
+import socket, pickle, struct
+from io import BytesIO
 from walt.common.tools import set_close_on_exec
 from walt.common.io import SmartFile
 
@@ -16,6 +17,8 @@ class Requests(object):
     REQ_API_SESSION = 10
     REQ_TCP_TO_NODE = 11
     REQ_FAKE_TFTP_GET = 12
+    REQ_MUX_INCOMING_LOGS = 13
+    REQ_DUMP_LOGS_BATCHED = 14
 
     # the request id message may be specified directly as
     # as a decimal string (e.g. '4') or by the corresponding
@@ -50,6 +53,121 @@ def write_pickle(obj, stream):
     pickle.dump(obj, stream, pickle.HIGHEST_PROTOCOL)
     stream.flush()
 
+# Framing of batched log records.
+# Each frame starts with its length (4 bytes, network order),
+# followed by the concatenation of several pickled records.
+# In this mode, records are sent as tuples with these fields:
+LOG_RECORD_FIELDS = ('timestamp', 'sender', 'stream', 'line')
+FRAME_HEADER = struct.Struct('!I')
+
+def encode_log_record(record):
+    return pickle.dumps(tuple(record[field] for field in LOG_RECORD_FIELDS),
+                        pickle.HIGHEST_PROTOCOL)
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+# The server may also send a status (a pickled string instead of a
+# tuple), e.g. to notify the outcome of a wait request.
+LOGS_WAIT_COMPLETED = 'WAIT_COMPLETED'
+LOGS_WAIT_TIMEOUT = 'WAIT_TIMEOUT'
+# sent after the history records, if the client requested it
+LOGS_HISTORY_COMPLETED = 'HISTORY_COMPLETED'
+
+# A client requesting REQ_DUMP_LOGS_BATCHED gets LOGS_DUMP_ACK, then
+# records are sent by frames, and the request may include parameters
+# wait, resume and history_status. An older server just closes the
+# connection, and the client falls back to REQ_DUMP_LOGS, where records
+# are sent as separate pickles unless 'batched' is specified.
+LOGS_DUMP_ACK = b'LOGS_DUMP_OK\n'
+
+def encode_status_frame(status):
+    return encode_frame(pickle.dumps(status, pickle.HIGHEST_PROTOCOL))
+
+def read_exactly(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+# Multiplexed log ingestion (REQ_MUX_INCOMING_LOGS).
+# A node sends the log lines of all its streams on a single connection.
+# The server first acknowledges the request with MUX_LOGS_ACK (an older
+# server just closes the connection, and the node falls back to one
+# REQ_NEW_INCOMING_LOGS connection per stream).
+# Then the node sends frames (FRAME_HEADER + payload), where the payload
+# is a sequence of messages:
+# - stream declaration: MUX_STREAM_HEADER (type, stream_num, length)
+#   followed by the stream name;
+# - log line: MUX_LOG_HEADER (type, stream_num, timestamp, length)
+#   followed by the line.
+# stream_num is chosen by the node to identify the stream on this
+# connection, and the stream must be declared before its first line.
+# The server closes the connection if a frame is larger than
+# MUX_MAX_FRAME_SIZE, thus the node truncates lines longer than
+# MUX_MAX_LINE_SIZE (and flushes frames much smaller than this).
+MUX_LOGS_ACK = b'MUX_LOGS_OK\n'
+MUX_MAX_FRAME_SIZE = 1024 * 1024
+MUX_MAX_LINE_SIZE = 64 * 1024
+MUX_MSG_STREAM = 0
+MUX_MSG_LOG = 1
+MUX_STREAM_HEADER = struct.Struct('!BHI')
+MUX_LOG_HEADER = struct.Struct('!BHdI')
+
+def encode_mux_stream(stream_num, name):
+    name = name.encode('UTF-8')
+    return MUX_STREAM_HEADER.pack(MUX_MSG_STREAM, stream_num, len(name)) + name
+
+def encode_mux_log(stream_num, timestamp, line):
+    return MUX_LOG_HEADER.pack(MUX_MSG_LOG, stream_num, timestamp, len(line)) + line
+
+# yield (MUX_MSG_STREAM, stream_num, name) and
+# (MUX_MSG_LOG, stream_num, timestamp, line) tuples
+def decode_mux_messages(payload):
+    pos = 0
+    while pos < len(payload):
+        if payload[pos] == MUX_MSG_STREAM:
+            msg_type, stream_num, length = \
+                    MUX_STREAM_HEADER.unpack_from(payload, pos)
+            pos += MUX_STREAM_HEADER.size
+            yield msg_type, stream_num, payload[pos:pos+length].decode('UTF-8')
+        elif payload[pos] == MUX_MSG_LOG:
+            msg_type, stream_num, timestamp, length = \
+                    MUX_LOG_HEADER.unpack_from(payload, pos)
+            pos += MUX_LOG_HEADER.size
+            yield msg_type, stream_num, timestamp, \
+                    payload[pos:pos+length].decode('UTF-8', 'ignore')
+        else:
+            raise ValueError('Unknown message type in log frame.')
+        pos += length
+
+# read a frame and return the list of log records it holds
+# (or None if the connection was closed).
+# a status is returned as a record with a single key 'status'.
+def read_log_records_frame(stream):
+    try:
+        header = read_exactly(stream, FRAME_HEADER.size)
+        if header is None:
+            return None
+        payload_len, = FRAME_HEADER.unpack(header)
+        payload = read_exactly(stream, payload_len)
+        if payload is None:
+            return None
+        f, records = BytesIO(payload), []
+        while f.tell() < payload_len:
+            item = pickle.load(f)
+            if isinstance(item, str):
+                records.append(dict(status = item))
+            else:
+                records.append(dict(zip(LOG_RECORD_FIELDS, item)))
+        return records
+    except Exception as e:
+        return None
+
 class SmartSocketFile(SmartFile):
     def __init__(self, sock):
         self.sock = sock
@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+"""
+Benchmark of the logs subsystem of walt server.
+
+Usage: dev/logs-benchmark.py [options] [fanout|ingest|storage|insert|reader|realtime-buffer ...]
+(to be run from the root of the repository, see --help for options)
+
+Results are printed as JSON on standard output (or written to the
+file given with --output), in order to compare them between versions.
+
+Scenario 'fanout': records are dispatched by the logs hub to 1, 10
+and 100 realtime clients connected through socketpairs. Clients are
+child processes which just read and discard their data.
+
+Scenario 'ingest': a LogsManager is instantiated with the event loop,
+the tcp server, the logs writer thread and the database of walt
+server, and simulated nodes
+send log lines (REQ_NEW_INCOMING_LOGS connections, and optionally
+netconsole datagrams) at the configured rate. We report the sustained
+throughput, the latency between the timestamp of a line and the commit
+of its db transaction, the lag of the main loop, and memory usage.
+This scenario needs the postgresql database of walt server (libpq
+environment variables such as PGHOST are honored), and the tcp and
+netconsole ports of walt server, so the server must be stopped.
+Simulated nodes are registered as devices 'logs-benchmark-<i>' with
+ip addresses 127.0.<i/250>.<i%250+2>, and removed at the end.
+
+Scenario 'storage': for several synthetic corpora of log lines
+(counters, kernel and system messages, experiment output, free text),
+records are written to the database with the 'plain' and 'templates'
+storage modes, and we report the disk usage of these records, and the
+speed of their retrieval (all lines of the stream, and lines matching
+a regular expression). This scenario also needs the database, and
+uses a device 'logs-benchmark-0' which is removed at the end.
+
+Scenario 'insert': records are written to the database one INSERT
+statement per record (the way walt server wrote them before batching),
+and with COPY batches of STORAGE_CHUNK_SIZE records, with and without
+an invalid record in each batch (which forces the batch to be bisected).
+We report the number of records written per second. This scenario also
+needs the database, and uses a device 'logs-benchmark-0'.
+
+Scenario 'reader': a child process sends log lines on a socketpair,
+and we read them after each wakeup of poll(), with one readline() call
+on an unbuffered socket file (the way walt server read log streams
+before using LineReader), or with LineReader.read_lines(). We report
+the number of lines read per second.
+
+Scenario 'realtime-buffer': realtime records are appended to the buffer
+used while a history dump is in progress (a plain list, as walt server
+did before, and a SpillableBuffer), then read back. We report the peak
+memory allocated (measured with tracemalloc, which also slows down both
+methods), and the number of records appended and read per second.
+"""
+import sys, os, socket, select, pickle, json, struct, resource, argparse, platform, random, \
+       tracemalloc
+from collections import namedtuple
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from time import time, sleep
+sys.path[:0] = [ os.path.join(os.getcwd(), d) for d in ('common', 'server') ]
+from walt.common.constants import WALT_SERVER_TCP_PORT, \
+                                  WALT_SERVER_NETCONSOLE_PORT
+from walt.common.evloop import EventLoop
+from walt.common.io import LineReader
+from walt.common.tcp import SmartSocketFile, TCPServer, Requests
+from walt.common.thread import EvThreadsManager
+from walt.common.version import __version__
+from walt.server.threads.main.logs import LogsHub, LogsToSocketHandler, \
+                                          LogStreamsRegistry, LogsManager, \
+                                          LogsStreamListener, SpillableBuffer, \
+                                          REALTIME_BUFFER_MAX_RECORDS
+
+DEFAULT_NUM_RECORDS = 100000
+FANOUT_NUM_CLIENTS = (1, 10, 100)
+DISPATCH_ROUND = 1000
+
+DEFAULT_INGEST_NODES = 10
+DEFAULT_INGEST_STREAMS = 1
+DEFAULT_INGEST_RATE = 1000
+DEFAULT_INGEST_DURATION = 10
+# simulated nodes send their lines every INGEST_TICK seconds
+# (or as fast as possible if rate is 0)
+INGEST_TICK = 0.01
+INGEST_MAX_BURST = 100
+# period of the main loop lag probe
+LAG_PROBE_PERIOD = 0.05
+# we record the latency of one record out of LATENCY_SAMPLING
+LATENCY_SAMPLING = 10
+BENCH_DEVICE_NAME = 'logs-benchmark-%d'
+BENCH_LINE = b'benchmark log line number %d of a simulated node, with some padding'
+SENT_COUNTS = struct.Struct('!QQ')
+
+STORAGE_MODES = ('plain', 'templates')
+STORAGE_CHUNK_SIZE = 1000
+STORAGE_REGEXP = 'error|fail'
+INVALID_STREAM_ID = -1
+KERNEL_FORMATS = (
+    'usb 1-1.%d: new high-speed USB device number %d using dwc_otg',
+    'eth0: link up, %d Mbps, full-duplex, lpa 0x%X',
+    'EXT4-fs (mmcblk0p%d): mounted filesystem with ordered data mode',
+    'systemd[%d]: Started Session %d of user root.',
+    'systemd[%d]: session-%d.scope: Succeeded.',
+    'CPU%d: failed to come online, error %d',
+    'Out of memory: Killed process %d (python3) total-vm:%dkB')
+WORDS = ('node', 'image', 'the', 'experiment', 'is', 'waiting', 'for',
+         'network', 'error', 'sensor', 'ready', 'message', 'received',
+         'from', 'gateway', 'restarting', 'service', 'done', 'value')
+
+Device = namedtuple('Device', ('mac', 'ip', 'name'))
+LogStream = namedtuple('LogStream', ('id', 'sender_mac', 'name'))
+
+# minimal replacement of the server db, with a single log stream
+class BenchDB(object):
+    def select(self, table, **kwargs):
+        if table == 'devices':
+            return [ Device('00:00:00:00:00:01', '192.168.152.2', 'node1') ]
+        elif table == 'logstreams':
+            return [ LogStream(1, '00:00:00:00:00:01', 'bench.stdout') ]
+
+def percentiles(values, *pcts):
+    values = sorted(values)
+    if len(values) == 0:
+        return { 'p%d' % p: None for p in pcts }
+    return { 'p%d' % p: values[min(len(values)-1, len(values) * p // 100)] \
+             for p in pcts }
+
+def max_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def fork_reader(sock, server_socks):
+    pid = os.fork()
+    if pid == 0:
+        # ensure we will detect EOF
+        for s in server_socks:
+            os.close(s.fileno())
+        while len(sock.recv(1024*1024)) > 0:
+            pass
+        os._exit(0)
+    sock.close()
+    return pid
+
+def create_client(hub, ev_loop, server_socks):
+    s_server, s_client = socket.socketpair()
+    server_socks.append(s_server)
+    params = dict(history = None, realtime = True, senders = ('node1',),
+                  streams = None, logline_regexp = None, batched = True)
+    s_client.sendall(pickle.dumps(params))
+    sock_file = SmartSocketFile(s_server)
+    handler = LogsToSocketHandler(None, None, hub, sock_file, None, ev_loop)
+    ev_loop.register_listener(handler)
+    handler.handle_event(time())
+    return handler, fork_reader(s_client, server_socks)
+
+def drain(ev_loop, handlers):
+    while any(len(h.out_queue) > 0 for h in handlers):
+        for fd, ev in ev_loop.poller.poll(100):
+            ev_loop.listeners[fd].handle_write_event(time())
+
+def bench_fanout(num_records, num_clients):
+    ev_loop = EventLoop()
+    hub = LogsHub(LogStreamsRegistry(BenchDB()))
+    server_socks = []
+    clients = [ create_client(hub, ev_loop, server_socks) \
+                for i in range(num_clients) ]
+    handlers = [ c[0] for c in clients ]
+    t0 = time()
+    for i in range(num_records):
+        hub.log(stream_id = 1, timestamp = datetime.now(),
+                line = 'benchmark log line number %d' % i)
+        if i % DISPATCH_ROUND == DISPATCH_ROUND-1:
+            drain(ev_loop, handlers)
+    for h in handlers:
+        h.flush_batch()
+    drain(ev_loop, handlers)
+    duration = time() - t0
+    for h, pid in clients:
+        h.close()
+        os.waitpid(pid, 0)
+    return duration
+
+def run_fanout(args):
+    results = []
+    for num_clients in FANOUT_NUM_CLIENTS:
+        duration = bench_fanout(args.records, num_clients)
+        results.append(dict(
+            clients = num_clients,
+            records = args.records,
+            duration_s = duration,
+            records_per_s = args.records / duration,
+            us_per_record_per_client = \
+                duration * 1000000 / args.records / num_clients))
+    return results
+
+# simulated nodes
+
+def node_ip(node_idx):
+    return '127.0.%d.%d' % (node_idx // 250, node_idx % 250 + 2)
+
+def node_mac(node_idx):
+    return '02:00:00:be:%02x:%02x' % (node_idx // 256, node_idx % 256)
+
+def send_lines(sock, num, first, timestamp):
+    sock.sendall(b''.join(b'%.6f ' % timestamp + BENCH_LINE % i + b'\n' \
+                          for i in range(first, first + num)))
+
+def send_datagrams(sock, num, first, kernel_ts):
+    for i in range(first, first + num):
+        sock.sendto(b'6,%d,%d,-;' % (i, kernel_ts) + BENCH_LINE % i + b'\n',
+                    ('127.0.0.1', WALT_SERVER_NETCONSOLE_PORT))
+
+def simulate_nodes(nodes, args):
+    streams, netconsoles = [], []
+    for node_idx in nodes:
+        for stream_idx in range(args.streams):
+            s = socket.socket()
+            s.bind((node_ip(node_idx), 0))
+            s.connect(('127.0.0.1', WALT_SERVER_TCP_PORT))
+            s.sendall(b'%d\nbench.%d\nTIMESTAMPS_INSIDE\n' % \
+                        (Requests.REQ_NEW_INCOMING_LOGS, stream_idx))
+            streams.append(s)
+        if args.netconsole_rate > 0:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind((node_ip(node_idx), 0))
+            netconsoles.append(s)
+    t0, sent_lines, sent_datagrams = time(), 0, 0
+    while True:
+        elapsed = time() - t0
+        if elapsed >= args.duration:
+            break
+        if args.rate == 0:
+            num = INGEST_MAX_BURST
+        else:
+            num = min(INGEST_MAX_BURST,
+                      int(elapsed * args.rate) - sent_lines // len(streams))
+        if num > 0:
+            for s in streams:
+                send_lines(s, num, sent_lines // len(streams), time())
+            sent_lines += num * len(streams)
+        if len(netconsoles) > 0:
+            num = min(INGEST_MAX_BURST,
+                      int(elapsed * args.netconsole_rate) - \
+                        sent_datagrams // len(netconsoles))
+            if num > 0:
+                for s in netconsoles:
+                    send_datagrams(s, num, sent_datagrams // len(netconsoles),
+                                   int((time() - t0) * 1000000))
+                sent_datagrams += num * len(netconsoles)
+        if args.rate > 0:
+            sleep(INGEST_TICK)
+    for s in streams + netconsoles:
+        s.close()
+    return sent_lines, sent_datagrams
+
+def fork_nodes(nodes, args):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        counts = simulate_nodes(nodes, args)
+        os.write(w, SENT_COUNTS.pack(*counts))
+        os._exit(0)
+    os.close(w)
+    return pid, r
+
+# instrumentation of the server side
+
+class IngestMonitor(object):
+    def __init__(self, writer_thread, logs, ev_loop, processes):
+        self.writer_thread = writer_thread
+        self.ev_loop = ev_loop
+        self.logs = logs
+        self.processes = processes
+        self.sent = [0, 0]
+        self.pending = []
+        self.latencies = []
+        self.committed = 0
+        self.last_commit = None
+        self.lags = []
+        self.next_probe = None
+        self.pauses = 0
+        # wrap db methods (of the logs writer thread) to follow
+        # records until they are committed
+        db = writer_thread.db
+        self.insert_logs, self.commit = db.insert_logs, db.commit
+        db.insert_logs, db.commit = self.on_insert_logs, self.on_commit
+        # count producer pauses caused by backpressure
+        self.pause_producers = logs.hub.pause_producers
+        logs.hub.pause_producers = self.on_pause_producers
+
+    def on_pause_producers(self):
+        self.pause_producers()
+        self.pauses += 1
+
+    def on_insert_logs(self, records):
+        self.insert_logs(records)
+        self.pending.extend(r[1] for r in records[::LATENCY_SAMPLING])
+        self.committed += len(records)
+
+    def on_commit(self):
+        self.commit()
+        now = datetime.now()
+        self.latencies.extend((now - ts).total_seconds() for ts in self.pending)
+        self.pending = []
+        self.last_commit = time()
+
+    def start(self):
+        self.next_probe = time() + LAG_PROBE_PERIOD
+        self.ev_loop.plan_event(ts = self.next_probe, target = self)
+
+    # main loop lag probe
+    def handle_planned_event(self):
+        now = time()
+        self.lags.append(now - self.next_probe)
+        self.reap_processes()
+        if len(self.processes) == 0 and not any( \
+                isinstance(l, LogsStreamListener) \
+                for l in self.ev_loop.listeners.values()):
+            self.stop()
+            return
+        self.next_probe = now + LAG_PROBE_PERIOD
+        self.ev_loop.plan_event(ts = self.next_probe, target = self)
+
+    def reap_processes(self):
+        for pid, r in list(self.processes.items()):
+            if os.waitpid(pid, os.WNOHANG) != (0, 0):
+                counts = SENT_COUNTS.unpack(os.read(r, SENT_COUNTS.size))
+                self.sent = [ a + b for a, b in zip(self.sent, counts) ]
+                os.close(r)
+                del self.processes[pid]
+
+    # all nodes are done, wait for netconsole datagrams still pending
+    # and for the db writes, then stop the writer thread and let the
+    # loop stop by removing all listeners
+    def stop(self):
+        sleep(LAG_PROBE_PERIOD)
+        self.logs.netconsole.handle_event(time())
+        self.logs.db_handler.flush_then(self.writes_done)
+
+    def writes_done(self, result):
+        self.writer_thread.forward_exception(Exception('End of benchmark.'))
+        self.writer_thread.join()
+        for l in list(self.ev_loop.listeners.values()):
+            self.ev_loop.remove_listener(l)
+
+def corpus_counter(rnd, i):
+    return 'iteration %d: sent %d packets in %.3f s' % \
+                (i, rnd.randint(0, 10000), rnd.random())
+
+def corpus_kernel(rnd, i):
+    fmt = rnd.choice(KERNEL_FORMATS)
+    return fmt % tuple(rnd.randint(0, 65535) for n in range(fmt.count('%')))
+
+def corpus_experiment(rnd, i):
+    return 'step=%d loss=%.6f acc=%.4f temp=%.1fC status=%s' % \
+                (i, rnd.random(), rnd.random(), rnd.uniform(30, 80),
+                 rnd.choice(('ok', 'ok', 'ok', 'error')))
+
+def corpus_freetext(rnd, i):
+    return ' '.join(rnd.choice(WORDS) for n in range(rnd.randint(4, 12)))
+
+CORPORA = dict(counter = corpus_counter, kernel = corpus_kernel,
+               experiment = corpus_experiment, freetext = corpus_freetext)
+
+def logs_disk_usage(db):
+    db.execute("""SELECT sum(pg_total_relation_size(c.oid))
+                  FROM pg_class c
+                  WHERE c.oid IN (SELECT inhrelid FROM pg_inherits
+                                  WHERE inhparent = 'logs'::regclass)
+                     OR c.oid = 'logs_templates'::regclass;""")
+    return int(db.c.fetchone()[0])
+
+# retrieve records by pages, the way history dumps do
+def read_logs(db, **params):
+    from walt.server.threads.blocking.logs import get_db_logs_pages
+    t0 = time()
+    num_records = sum(len(records) for records in get_db_logs_pages(db, **params))
+    return num_records, time() - t0
+
+def bench_storage(db, corpus, mode, num_records):
+    stream_id = db.insert('logstreams', returning = 'id',
+                          sender_mac = node_mac(0),
+                          name = 'storage.%s.%s' % (corpus, mode))
+    db.commit()
+    db.logs_storage = mode
+    db.logs_templates_used = (mode == 'templates')
+    db.logs_templates = None
+    # same lines for both modes
+    rnd = random.Random(corpus)
+    gen_line = CORPORA[corpus]
+    timestamp = datetime.now()
+    size_before = logs_disk_usage(db)
+    t0 = time()
+    raw_size = 0
+    for first in range(0, num_records, STORAGE_CHUNK_SIZE):
+        records = []
+        for i in range(first, min(first + STORAGE_CHUNK_SIZE, num_records)):
+            line = gen_line(rnd, i)
+            raw_size += len(line)
+            records.append((stream_id, timestamp + timedelta(microseconds = i),
+                            line, i))
+        db.insert_logs(records)
+        db.commit()
+    insert_duration = time() - t0
+    size = logs_disk_usage(db) - size_before
+    read_records, read_duration = read_logs(db, stream_ids = [ stream_id ])
+    matching_records, regexp_duration = read_logs(db, stream_ids = [ stream_id ],
+                                                  logline_regexp = STORAGE_REGEXP)
+    db.execute('SELECT count(*) FROM logs_templates WHERE stream_id = %s;',
+               (stream_id,))
+    num_templates = db.c.fetchone()[0]
+    db.commit()
+    return dict(
+        raw_lines_bytes = raw_size,
+        disk_usage_bytes = size,
+        templates = num_templates,
+        insert_records_per_s = num_records / insert_duration,
+        read_records = read_records,
+        read_records_per_s = read_records / read_duration,
+        regexp_matching_records = matching_records,
+        regexp_read_s = regexp_duration)
+
+def run_storage(args):
+    from walt.server.threads.main.db import ServerDB
+    from walt.server.threads.blocking.logs import prune_db_logs
+    db = ServerDB()
+    remove_bench_devices(db, 1)     # left by an interrupted run
+    add_bench_devices(db, 1)
+    results = dict(records = args.records)
+    for corpus in CORPORA:
+        results[corpus] = { mode: bench_storage(db, corpus, mode, args.records) \
+                            for mode in STORAGE_MODES }
+    remove_bench_devices(db, 1)
+    while prune_db_logs(db):
+        pass
+    return results
+
+def insert_per_record(db, records):
+    for stream_id, timestamp, line, log_id in records:
+        db.insert('logs', stream_id = stream_id, timestamp = timestamp,
+                  line = line, id = log_id)
+
+def insert_batch(db, records):
+    db.insert_logs(records)
+
+def insert_batch_invalid(db, records):
+    # a record of an unknown log stream violates the foreign key
+    invalid = (INVALID_STREAM_ID,) + records[0][1:]
+    db.insert_logs(records[:-1] + [ invalid ])
+
+INSERT_METHODS = dict(per_record = insert_per_record, copy = insert_batch,
+                      copy_with_invalid_record = insert_batch_invalid)
+
+def bench_insert(db, method, num_records):
+    stream_id = db.insert('logstreams', returning = 'id',
+                          sender_mac = node_mac(0),
+                          name = 'insert.%s' % method)
+    db.commit()
+    insert = INSERT_METHODS[method]
+    timestamp = datetime.now()
+    t0 = time()
+    for first in range(0, num_records, STORAGE_CHUNK_SIZE):
+        records = [ (stream_id, timestamp + timedelta(microseconds = i),
+                     BENCH_LINE.decode() % i, i) \
+                    for i in range(first, min(first + STORAGE_CHUNK_SIZE,
+                                              num_records)) ]
+        insert(db, records)
+        db.commit()
+    duration = time() - t0
+    return dict(duration_s = duration, records_per_s = num_records / duration)
+
+def run_insert(args):
+    from walt.server.threads.main.db import ServerDB
+    from walt.server.threads.blocking.logs import prune_db_logs
+    db = ServerDB()
+    db.logs_storage = 'plain'
+    remove_bench_devices(db, 1)     # left by an interrupted run
+    add_bench_devices(db, 1)
+    # avoid the messages about dropped records
+    with redirect_stdout(open(os.devnull, 'w')):
+        results = { method: bench_insert(db, method, args.records) \
+                    for method in INSERT_METHODS }
+    results.update(records = args.records, batch_size = STORAGE_CHUNK_SIZE)
+    remove_bench_devices(db, 1)
+    while prune_db_logs(db):
+        pass
+    return results
+
+def read_lines_readline(sock_file):
+    line = sock_file.readline()
+    return -1 if line == b'' else 1   # -1 means EOF
+
+def read_lines_reader(reader):
+    num_lines = len(reader.read_lines())
+    return -1 if num_lines == 0 and reader.eof else num_lines
+
+READER_METHODS = dict(
+        readline = (SmartSocketFile, read_lines_readline),
+        line_reader = (lambda s: LineReader(s), read_lines_reader))
+
+def bench_reader(method, num_lines):
+    s_server, s_client = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        s_server.close()
+        for first in range(0, num_lines, INGEST_MAX_BURST):
+            send_lines(s_client, min(INGEST_MAX_BURST, num_lines - first),
+                       first, time())
+        s_client.close()
+        os._exit(0)
+    s_client.close()
+    create_reader, read_lines = READER_METHODS[method]
+    reader = create_reader(s_server)
+    poller = select.poll()
+    poller.register(s_server.fileno(), select.POLLIN)
+    t0, num_read, wakeups = time(), 0, 0
+    while True:
+        poller.poll()
+        wakeups += 1
+        num = read_lines(reader)
+        if num < 0:
+            break   # EOF
+        num_read += num
+    duration = time() - t0
+    os.waitpid(pid, 0)
+    s_server.close()
+    return dict(lines = num_read, wakeups = wakeups,
+                duration_s = duration, lines_per_s = num_read / duration)
+
+def run_reader(args):
+    return { method: bench_reader(method, args.records) \
+             for method in READER_METHODS }
+
+REALTIME_BUFFER_METHODS = dict(
+        list = lambda: [],
+        spillable = lambda: SpillableBuffer(REALTIME_BUFFER_MAX_RECORDS))
+
+def bench_realtime_buffer(method, num_records):
+    timestamp = datetime.now()
+    tracemalloc.start()
+    buf = REALTIME_BUFFER_METHODS[method]()
+    t0 = time()
+    for i in range(num_records):
+        buf.append(dict(stream_id = 1,
+                        timestamp = timestamp + timedelta(microseconds = i),
+                        line = BENCH_LINE.decode() % i))
+    append_duration = time() - t0
+    t0 = time()
+    read_records = sum(1 for record in buf)
+    read_duration = time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(peak_memory_kib = peak // 1024,
+                appended_records_per_s = num_records / append_duration,
+                read_records = read_records,
+                read_records_per_s = read_records / read_duration)
+
+def run_realtime_buffer(args):
+    results = { method: bench_realtime_buffer(method, args.records) \
+                for method in REALTIME_BUFFER_METHODS }
+    results.update(records = args.records,
+                   max_records_in_memory = REALTIME_BUFFER_MAX_RECORDS)
+    return results
+
+# tasks of the blocking thread are not part of this benchmark
+class NoBlockingTasks(object):
+    def archive_logs(self, result_cb):
+        pass
+
+def add_bench_devices(db, num_nodes):
+    for node_idx in range(num_nodes):
+        db.insert('devices', mac = node_mac(node_idx), ip = node_ip(node_idx),
+                  name = BENCH_DEVICE_NAME % node_idx, type = 'node')
+    db.commit()
+
+def remove_bench_devices(db, num_nodes):
+    for node_idx in range(num_nodes):
+        if db.select_unique('devices', mac = node_mac(node_idx)) is not None:
+            db.forget_device(BENCH_DEVICE_NAME % node_idx)
+
+def run_ingest(args):
+    from walt.server.threads.main.db import ServerDB
+    from walt.server.threads.main.logswriter import LogsWriterManager
+    from walt.server.threads.logswriter.thread import ServerLogsWriterThread
+    db = ServerDB()
+    remove_bench_devices(db, args.nodes)    # left by an interrupted run
+    add_bench_devices(db, args.nodes)
+    ev_loop = EventLoop()
+    tcp_server = TCPServer(WALT_SERVER_TCP_PORT)
+    tcp_server.join_event_loop(ev_loop)
+    writer_thread = ServerLogsWriterThread(EvThreadsManager())
+    writer = LogsWriterManager()
+    writer.connect(writer_thread)
+    ev_loop.register_listener(writer)
+    logs = LogsManager(db, tcp_server, NoBlockingTasks(), writer, ev_loop)
+    db.plan_auto_commit(ev_loop)
+    monitor = IngestMonitor(writer_thread, logs, ev_loop, {})
+    writer_thread.start()
+    rss_before = max_rss_kib()
+    num_processes = min(args.nodes, os.cpu_count() or 1)
+    t0 = time()
+    for i in range(num_processes):
+        pid, r = fork_nodes(range(i, args.nodes, num_processes), args)
+        monitor.processes[pid] = r
+    monitor.start()
+    ev_loop.loop()
+    duration = time() - t0
+    rss_after = max_rss_kib()
+    lost = monitor.sent[0] + monitor.sent[1] - monitor.committed
+    remove_bench_devices(db, args.nodes)
+    return dict(
+        nodes = args.nodes,
+        streams_per_node = args.streams,
+        rate_per_stream = args.rate,
+        netconsole_rate_per_node = args.netconsole_rate,
+        duration_s = duration,
+        sent_lines = monitor.sent[0],
+        sent_netconsole = monitor.sent[1],
+        committed_records = monitor.committed,
+        lost_records = max(lost, 0),
+        producer_pauses = monitor.pauses,
+        records_per_s = monitor.committed / duration,
+        commit_latency_s = dict(
+            percentiles(monitor.latencies, 50, 90, 99),
+            max = max(monitor.latencies, default = None)),
+        loop_lag_s = dict(
+            percentiles(monitor.lags, 50, 90, 99),
+            max = max(monitor.lags, default = None)),
+        max_rss_kib = dict(before = rss_before, after = rss_after))
+
+SCENARIOS = dict(fanout = run_fanout, ingest = run_ingest, storage = run_storage,
+                 insert = run_insert, reader = run_reader,
+                 **{ 'realtime-buffer': run_realtime_buffer })
+
+def run():
+    parser = argparse.ArgumentParser(
+            description = 'Benchmark of the logs subsystem of walt server.')
+    parser.add_argument('scenarios', nargs = '*',
+            default = [ 'fanout' ], metavar = 'SCENARIO',
+            help = 'fanout, ingest, storage, insert, reader and/or realtime-buffer (default: fanout)')
+    parser.add_argument('--records', type = int, default = DEFAULT_NUM_RECORDS,
+            help = 'fanout: number of records dispatched, storage: number of records per corpus, insert, reader and realtime-buffer: number of records per method')
+    parser.add_argument('--nodes', type = int, default = DEFAULT_INGEST_NODES,
+            help = 'ingest: number of simulated nodes')
+    parser.add_argument('--streams', type = int, default = DEFAULT_INGEST_STREAMS,
+            help = 'ingest: number of log streams per node')
+    parser.add_argument('--rate', type = int, default = DEFAULT_INGEST_RATE,
+            help = 'ingest: lines per second per stream (0 means no limit)')
+    parser.add_argument('--netconsole-rate', type = int, default = 0,
+            help = 'ingest: netconsole lines per second per node')
+    parser.add_argument('--duration', type = float,
+            default = DEFAULT_INGEST_DURATION,
+            help = 'ingest: duration of the simulation, in seconds')
+    parser.add_argument('--output', help = 'write JSON results to this file')
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario: %s' % scenario)
+    results = dict(version = __version__, python = platform.python_version(),
+                   date = datetime.now().isoformat())
+    # messages of the server code must not be mixed with the JSON output
+    with redirect_stdout(sys.stderr):
+        for scenario in args.scenarios:
+            results[scenario] = SCENARIOS[scenario](args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    else:
+        json.dump(results, sys.stdout, indent = 2)
+        print()
+
+if __name__ == '__main__':
+    run()
@@ -1,9 +1,9 @@
 from time import time
-from walt.node.logs.flow import LogsFlowToServer
+from walt.node.logs.flow import get_logs_flow
 
 # User may issue multiple walt-echo commands, resulting
-# in many tcp connections to the server.
-# In order to avoid this, we keep a cache of connections
+# in many log flows to the server.
+# In order to avoid this, we keep a cache of log flows
 # temporarily, one per stream name.
 
 LOGCONN_CACHE_MIN_DELAY = 15
@@ -14,7 +14,7 @@ class LogsConnCache(object):
         self.conns = {}
     def get(self, stream_name):
         if stream_name not in self.conns:
-            self.conns[stream_name] = LogsFlowToServer(stream_name)
+            self.conns[stream_name] = get_logs_flow(stream_name)
         return self.conns[stream_name]
     def cleanup(self):
         limit = time() - LOGCONN_CACHE_MIN_DELAY
@@ -1,10 +1,329 @@
-import subprocess
+import errno, os, socket, subprocess
+from select import select
+from threading import Lock
 from time import time
+from walt.common.tcp import Requests, MUX_LOGS_ACK, MUX_MAX_LINE_SIZE, \
+                            MUX_MSG_STREAM, encode_frame, encode_mux_stream, \
+                            encode_mux_log, decode_mux_messages
 from walt.common.tools import remove_non_utf8
+from walt.node.logs.spool import LogsSpool, LOGS_SPOOL_DIR
 
 WALT_LOG_CAT_BINARY = subprocess.check_output('which walt-log-cat',
                             shell = True).strip()
 
+# Log lines of all streams are sent to the server on a single
+# connection (see REQ_MUX_INCOMING_LOGS in walt.common.tcp).
+# Lines are batched, and sent when MUX_FLUSH_MAX_SIZE bytes are
+# pending or at most MUX_FLUSH_PERIOD seconds later.
+# If the connection is lost, we try to reconnect at most every
+# MUX_RETRY_DELAY seconds, and record log lines in a spool meanwhile
+# (see spool.py). Spooled lines are replayed when the connection
+# is back.
+# If the server turns out not to handle this protocol (older server),
+# lines queued or spooled meanwhile, and next lines of the streams
+# already open, are sent through a LogsFlowToServer per stream (see
+# fall_back()), and we stop trying to connect.
+# Connecting must not block the event loop of the daemon (the server
+# may be unreachable for a long time): the connection is established
+# in the background, and its progress is checked on each flush; it is
+# given up after MUX_CONNECT_TIMEOUT seconds. Once connected, sending
+# a batch blocks at most MUX_SEND_TIMEOUT seconds.
+MUX_CONNECT_TIMEOUT = 5
+MUX_SEND_TIMEOUT    = 5
+MUX_FLUSH_MAX_SIZE  = 64 * 1024
+MUX_FLUSH_PERIOD    = 0.1
+MUX_RETRY_DELAY     = 10
+EV_MUX_FLUSH        = 0
+
+def get_server_address():
+    out = subprocess.check_output(
+            '. walt-env; echo $walt_server_ip $walt_server_logs_port',
+            shell = True)
+    ip, port = out.decode('ascii').split()
+    return ip, int(port)
+
+def encode_line(line):
+    if isinstance(line, str):
+        line = line.encode('UTF-8', 'ignore')
+    else:
+        line = remove_non_utf8(line)
+    return line[:MUX_MAX_LINE_SIZE]
+
+class LogsMux(object):
+    def __init__(self):
+        # log flows may be used by monitor threads
+        self.lock = Lock()
+        self.sock = None
+        # None until we know if the server handles this protocol
+        self.supported = None
+        self.last_attempt = 0
+        self.server_address = None
+        # socket being connected, and ack received so far
+        # (None until the request is sent)
+        self.connecting = None
+        self.ack = None
+        # stream name -> stream_num
+        self.stream_nums = {}
+        self.free_nums = []
+        # streams closed since last flush
+        self.released = []
+        self.batch = []
+        self.batch_size = 0
+        # whether the server should learn again our streams
+        self.declare_all = False
+        self.spool = None
+        # stream_num -> LogsFlowToServer, with an older server
+        self.fallback_flows = {}
+
+    def get_spool(self):
+        if self.spool is None:
+            try:
+                self.spool = LogsSpool()
+            except OSError as e:
+                print('Could not create logs spool: %s' % e)
+        return self.spool
+
+    def has_spooled_data(self):
+        return self.spool is not None and not self.spool.is_empty()
+
+    def stream_declarations(self):
+        return [ encode_mux_stream(stream_num, name) \
+                 for name, stream_num in self.stream_nums.items() ]
+
+    def join_event_loop(self, ev_loop):
+        # let us know early if the server handles this protocol
+        with self.lock:
+            self.connect()
+        ev_loop.plan_event(
+            ts = time(),
+            target = self,
+            repeat_delay = MUX_FLUSH_PERIOD,
+            ev_type = EV_MUX_FLUSH
+        )
+
+    def handle_planned_event(self, ev_type):
+        assert(ev_type == EV_MUX_FLUSH)
+        self.flush()
+
+    # if the server is unreachable, or the connection is in progress,
+    # we do not know yet.
+    def is_supported(self):
+        with self.lock:
+            return self.supported != False
+
+    # start connecting in the background (see continue_connect())
+    def connect(self):
+        self.last_attempt = time()
+        try:
+            if self.server_address is None:
+                self.server_address = get_server_address()
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except (OSError, subprocess.CalledProcessError):
+            return      # will retry later
+        s.setblocking(False)
+        if s.connect_ex(self.server_address) not in (0, errno.EINPROGRESS):
+            s.close()
+            return      # server unreachable
+        self.connecting, self.ack = s, None
+
+    def continue_connect(self):
+        s = self.connecting
+        try:
+            if self.ack is None:
+                r, w, x = select([], [s], [], 0)
+                if len(w) == 0:
+                    return self.check_connect_timeout()
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+                # the send buffer of a new socket is empty, thus
+                # this short request is sent at once
+                s.send(b'%d\n' % Requests.REQ_MUX_INCOMING_LOGS)
+                self.ack = b''
+            while not self.ack.endswith(b'\n'):
+                chunk = s.recv(len(MUX_LOGS_ACK) - len(self.ack))
+                if chunk == b'':
+                    break   # closed by the server
+                self.ack += chunk
+        except BlockingIOError:
+            return self.check_connect_timeout()
+        except OSError:
+            self.abort_connect()
+            return          # server unreachable
+        self.connecting = None
+        if self.ack != MUX_LOGS_ACK:
+            # older server
+            s.close()
+            self.supported = False
+            self.fall_back()
+            return
+        s.settimeout(MUX_SEND_TIMEOUT)
+        self.supported = True
+        self.sock = s
+        self.declare_all = True
+        if self.spool is None and os.path.isdir(LOGS_SPOOL_DIR):
+            # lines spooled by a previous run of the daemon
+            self.get_spool()
+
+    def check_connect_timeout(self):
+        if time() - self.last_attempt > MUX_CONNECT_TIMEOUT:
+            self.abort_connect()
+
+    def abort_connect(self):
+        self.connecting.close()
+        self.connecting = None
+
+    def fall_back(self):
+        flows = {}  # stream name -> flow
+        for name, stream_num in self.stream_nums.items():
+            flows[name] = LogsFlowToServer(name)
+            self.fallback_flows[stream_num] = flows[name]
+        payloads = []
+        if self.spool is None and os.path.isdir(LOGS_SPOOL_DIR):
+            # lines spooled by a previous run of the daemon
+            self.get_spool()
+        if self.spool is not None:
+            payloads.extend(self.spool.drain())
+        if len(self.batch) > 0:
+            payloads.append(b''.join(self.stream_declarations() + self.batch))
+            self.batch, self.batch_size = [], 0
+        for payload in payloads:
+            # each payload declares the streams it uses
+            # (spooled ones may come from a previous run)
+            names = {}
+            for msg in decode_mux_messages(payload):
+                if msg[0] == MUX_MSG_STREAM:
+                    stream_num, name = msg[1:]
+                    names[stream_num] = name
+                    continue
+                stream_num, timestamp, line = msg[1:]
+                name = names[stream_num]
+                if name not in flows:
+                    flows[name] = LogsFlowToServer(name)
+                flows[name].log(line, timestamp)
+        # close the flows of streams not open anymore
+        for name, flow in flows.items():
+            if name not in self.stream_nums:
+                flow.close()
+        self.free_released()
+
+    def add_stream(self, name):
+        with self.lock:
+            if name in self.stream_nums:
+                stream_num = self.stream_nums[name]
+                if stream_num in self.released:
+                    self.released.remove(stream_num)
+            else:
+                if len(self.free_nums) > 0:
+                    stream_num = self.free_nums.pop()
+                else:
+                    stream_num = len(self.stream_nums) + len(self.free_nums)
+                self.stream_nums[name] = stream_num
+            if self.supported is False:
+                if stream_num not in self.fallback_flows:
+                    self.fallback_flows[stream_num] = LogsFlowToServer(name)
+            else:
+                self.queue(encode_mux_stream(stream_num, name))
+            return stream_num
+
+    def release_stream(self, stream_num):
+        with self.lock:
+            # the stream number will be reusable once its
+            # pending lines are sent
+            self.released.append(stream_num)
+            if self.supported is False:
+                self.free_released()
+
+    def log(self, stream_num, timestamp, line):
+        with self.lock:
+            if self.supported is False:
+                self.fallback_flows[stream_num].log(line, timestamp)
+            else:
+                self.queue(encode_mux_log(stream_num, timestamp,
+                                          encode_line(line)))
+
+    def queue(self, msg):
+        self.batch.append(msg)
+        self.batch_size += len(msg)
+        if self.batch_size >= MUX_FLUSH_MAX_SIZE:
+            self.send_batch()
+
+    def flush(self):
+        with self.lock:
+            self.send_batch()
+
+    def send_batch(self):
+        if self.supported is False:
+            return  # see fall_back()
+        if self.connecting is not None:
+            self.continue_connect()
+        if len(self.batch) == 0 and not self.has_spooled_data():
+            return
+        if self.sock is None:
+            if self.connecting is None and \
+                    time() - self.last_attempt >= MUX_RETRY_DELAY:
+                self.connect()
+            self.spool_batch()
+            return
+        try:
+            if self.has_spooled_data():
+                self.spool.replay(self.sock)
+                # stream numbers were re-declared by spooled frames
+                self.declare_all = True
+            if len(self.batch) > 0:
+                msgs = self.batch
+                if self.declare_all:
+                    msgs = self.stream_declarations() + msgs
+                self.sock.sendall(encode_frame(b''.join(msgs)))
+                self.declare_all = False
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            self.spool_batch()
+            return
+        self.batch, self.batch_size = [], 0
+        self.free_released()
+
+    # record pending lines in the spool, with the declarations
+    # of our streams (numbers may be reused when they are replayed)
+    def spool_batch(self):
+        if len(self.batch) == 0:
+            return
+        spool = self.get_spool()
+        if spool is not None:
+            msgs = self.stream_declarations() + self.batch
+            spool.append(encode_frame(b''.join(msgs)))
+        self.batch, self.batch_size = [], 0
+        self.free_released()
+
+    def free_released(self):
+        for stream_num in self.released:
+            for name, num in list(self.stream_nums.items()):
+                if num == stream_num:
+                    del self.stream_nums[name]
+            flow = self.fallback_flows.pop(stream_num, None)
+            if flow is not None:
+                flow.close()
+            self.free_nums.append(stream_num)
+        self.released = []
+
+logs_mux = LogsMux()
+
+# Log flow of a stream, sent through the multiplexed connection.
+class LogsMuxStream(object):
+    def __init__(self, stream_name):
+        self.stream_num = logs_mux.add_stream(stream_name)
+        self.last_used = time()
+    def log(self, line, timestamp = None):
+        if timestamp == None:
+            timestamp = time()
+        logs_mux.log(self.stream_num, timestamp, line)
+        self.last_used = time()
+    def close(self):
+        logs_mux.release_stream(self.stream_num)
+
+# Log flow of a stream, sent through a dedicated connection.
+# This is used when the server does not handle multiplexed connections.
 class LogsFlowToServer(object):
     def __init__(self, stream_name):
         self.popen = subprocess.Popen([WALT_LOG_CAT_BINARY, '--ts', stream_name],
@@ -14,8 +333,14 @@ class LogsFlowToServer(object):
     def log(self, line, timestamp = None):
         if timestamp == None:
             timestamp = time()
-        self.stream.write('%.6f %s\n' % (timestamp, remove_non_utf8(line)))
+        self.stream.write(b'%.6f %s\n' % (timestamp, encode_line(line)))
         self.stream.flush()
         self.last_used = time()
     def close(self):
         self.stream.close()
+
+def get_logs_flow(stream_name):
+    if logs_mux.is_supported():
+        return LogsMuxStream(stream_name)
+    else:
+        return LogsFlowToServer(stream_name)
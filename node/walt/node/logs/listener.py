@@ -2,7 +2,7 @@ from threading import Thread
 from walt.common.fifo import open_readable_fifo
 from walt.node.logs.monitor import handle_monitor_request
 from walt.node.logs.cache import LogsConnCache
-from walt.node.logs.flow import LogsFlowToServer
+from walt.node.logs.flow import logs_mux
 
 WALT_LOGS_FIFO = '/var/lib/walt/logs.fifo'
 
@@ -14,6 +14,7 @@ class LogsFifoListener(object):
     def join_event_loop(self, ev_loop):
         ev_loop.register_listener(self)
         self.conn_cache.join_event_loop(ev_loop)
+        logs_mux.join_event_loop(ev_loop)
 
     # let the event loop know what we are reading on
     def fileno(self):
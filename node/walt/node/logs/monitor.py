@@ -3,7 +3,7 @@ import os, time, select
 from walt.common.tools import fd_copy, set_non_blocking
 from walt.common.tty import set_tty_size,     \
                             acquire_controlling_tty, tty_disable_echoctl
-from walt.node.logs.flow import LogsFlowToServer
+from walt.node.logs.flow import get_logs_flow
 
 # See comments in node/sh/walt-monitor.
 # This file implements the server side part of walt-monitor.
@@ -35,7 +35,7 @@ def parent_handler(pid, pipe_r, tty_master_fd, args, **kwargs):
     logstream = "%s.%d.monitor" % (
         os.path.basename(args[2]), pid
     )
-    logs_conn = LogsFlowToServer(logstream)
+    logs_conn = get_logs_flow(logstream)
     logs_conn.log(line='START', timestamp=time.time())
     tty_out = os.open('/tmp/walt-monitor-stdout-%d.fifo' % pid, os.O_WRONLY)
     tty_in = os.open('/tmp/walt-monitor-stdin-%d.fifo' % pid, os.O_RDONLY)
@@ -0,0 +1,109 @@
+import os
+from walt.common.tcp import FRAME_HEADER
+from walt.common.tools import failsafe_makedirs
+
+# When the server is unreachable, log frames are recorded in this
+# spool, and replayed when the connection is back.
+# The spool is a bounded ring of segment files: when it exceeds its
+# maximum size, the oldest segment is dropped.
+# Directory and size may be changed in /etc/default/walt-logs, e.g.:
+# WALT_LOGS_SPOOL_DIR=/tmp/walt-logs-spool   (tmpfs)
+# WALT_LOGS_SPOOL_SIZE=67108864              (bytes)
+LOGS_SPOOL_DIR = os.environ.get('WALT_LOGS_SPOOL_DIR', '/var/lib/walt/logs-spool')
+LOGS_SPOOL_MAX_SIZE = int(os.environ.get('WALT_LOGS_SPOOL_SIZE', 16 * 1024 * 1024))
+LOGS_SPOOL_NUM_SEGMENTS = 16
+
+# keep only complete frames (the end of a segment may be missing
+# if the daemon was killed while writing it)
+def complete_frames(data):
+    pos = 0
+    while len(data) - pos >= FRAME_HEADER.size:
+        length, = FRAME_HEADER.unpack_from(data, pos)
+        end = pos + FRAME_HEADER.size + length
+        if end > len(data):
+            break
+        pos = end
+    return data[:pos]
+
+class LogsSpool(object):
+    def __init__(self, path = LOGS_SPOOL_DIR, max_size = LOGS_SPOOL_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.segment_max_size = max_size // LOGS_SPOOL_NUM_SEGMENTS
+        failsafe_makedirs(path)
+        # segments left by a previous run will be replayed too
+        self.segments = {}  # segment num -> size
+        for name in os.listdir(path):
+            if name.isdigit():
+                self.segments[int(name)] = os.path.getsize(self.segment_path(int(name)))
+        # file of the segment being written
+        self.current, self.current_num = None, None
+
+    def segment_path(self, num):
+        return os.path.join(self.path, '%012d' % num)
+
+    def is_empty(self):
+        return len(self.segments) == 0
+
+    def size(self):
+        return sum(self.segments.values())
+
+    def append(self, frame):
+        try:
+            if self.current is None or \
+                    self.segments[self.current_num] >= self.segment_max_size:
+                self.open_segment()
+            self.current.write(frame)
+            self.current.flush()
+            self.segments[self.current_num] += len(frame)
+        except OSError as e:
+            print('Could not write to logs spool: %s' % e)
+            self.close_segment()
+            return
+        while self.size() > self.max_size and len(self.segments) > 1:
+            oldest = min(self.segments)
+            print('Logs spool is full, dropping oldest log lines.')
+            self.remove_segment(oldest)
+
+    def open_segment(self):
+        self.close_segment()
+        self.current_num = max(self.segments, default = -1) + 1
+        self.current = open(self.segment_path(self.current_num), 'ab')
+        self.segments[self.current_num] = 0
+
+    def close_segment(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+    def remove_segment(self, num):
+        if num == self.current_num:
+            self.close_segment()
+        os.remove(self.segment_path(num))
+        del self.segments[num]
+
+    # yield the payloads of all spooled frames, oldest first, and
+    # empty the spool.
+    def drain(self):
+        self.close_segment()
+        for num in sorted(self.segments):
+            with open(self.segment_path(num), 'rb') as f:
+                data = complete_frames(f.read())
+            pos = 0
+            while pos < len(data):
+                length, = FRAME_HEADER.unpack_from(data, pos)
+                pos += FRAME_HEADER.size
+                yield data[pos:pos+length]
+                pos += length
+            self.remove_segment(num)
+
+    # send all spooled frames, oldest first.
+    # if the connection fails, segments not sent completely are kept
+    # (and their frames may be sent again later).
+    def replay(self, sock):
+        self.close_segment()
+        for num in sorted(self.segments):
+            with open(self.segment_path(num), 'rb') as f:
+                data = complete_frames(f.read())
+            sock.sendall(data)
+            self.remove_segment(num)
@@ -4,6 +4,7 @@ from walt.common.thread import EvThreadsManager
 from walt.server.threads.main.thread import ServerMainThread
 from walt.server.threads.blocking.thread import ServerBlockingThread
 from walt.server.threads.hub.thread import ServerHubThread
+from walt.server.threads.logswriter.thread import ServerLogsWriterThread
 
 def run():
     # exit gracefully on SIGTERM
@@ -16,9 +17,12 @@ def run():
     blocking_thread = ServerBlockingThread(tman, main_thread.server)
     # create hub thread
     hub_thread = ServerHubThread(tman)
+    # create logs writer thread
+    logs_writer_thread = ServerLogsWriterThread(tman)
     # connect them
     main_thread.blocking.connect(blocking_thread.main)
     main_thread.hub.connect(hub_thread.main)
+    main_thread.logs_writer.connect(logs_writer_thread)
     # start!
     tman.start()
 
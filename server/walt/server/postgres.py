@@ -20,6 +20,11 @@ class PostgresDB():
         # allow name-based access to columns
         self.c = self.conn.cursor(cursor_factory = NamedTupleCursor)
         self.server_cursors = {}
+        # True if the current transaction may have modified the database.
+        # It is set by execute() and by the write helpers below (insert(),
+        # update(), delete()); the select helpers do not set it. Code which
+        # uses the cursor self.c directly must set it when relevant.
+        self.dirty = False
 
     def __del__(self):
         self.conn.commit()
@@ -40,9 +45,11 @@ class PostgresDB():
 
     def commit(self):
         self.conn.commit()
+        self.dirty = False
 
     def execute(self, query, query_args = None):
         self.c.execute(query, query_args)
+        self.dirty = True   # we do not know
         return self.c
 
     # with server cursors, the resultset is not sent all at once to the client.
@@ -112,6 +119,7 @@ class PostgresDB():
         if returning:
             sql += " RETURNING %s" % returning
         self.c.execute(sql + ';', tuple(values))
+        self.dirty = True
         if returning:
             return self.c.fetchone()[0]
 
@@ -122,6 +130,7 @@ class PostgresDB():
         where_clause = self.get_where_clause_pattern(cols)
         sql = "DELETE FROM %s %s;" % (table, where_clause)
         self.c.execute(sql, values)
+        self.dirty = True
         return self.c.rowcount  # number of rows deleted
 
     # allow statements like:
@@ -137,6 +146,7 @@ class PostgresDB():
                     ','.join("%s = %%s" % col for col in cols),
                     primary_key_name),
                     values)
+        self.dirty = True
         return self.c.rowcount  # number of rows updated
 
     def select_no_fetch(self, table, **kwargs):
@@ -1,20 +1,206 @@
+import re, time
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import chain, islice
+from operator import itemgetter
+from walt.server import conf
+from walt.server.threads.main.logsarchive import LOGS_ARCHIVE, \
+            iter_archived_logs, archive_logs_partition, drop_archived_logs
 
-def stream_db_logs(db, logs_handler, **params):
-    # ensure all past logs are commited
-    db.commit()
-    # let the logs handler start buffering realtime logs
-    logs_handler.notify_history_processing_startup()
-    db.commit()
-    # create a server cursor
-    cursor_name = db.create_server_cursor()
-    # start streaming db logs
-    for record in db.get_logs(cursor_name, **params):
-        d = record._asdict()
-        if logs_handler.write_to_client(
-                    senders_filtered = True, **d) == False:
+# records are sent to the main thread by chunks, in order to
+# avoid a costly inter-thread round trip for each record.
+# each chunk is retrieved from db with a separate query (keyset
+# pagination, see ServerDB.get_logs_page()), thus a long dump does
+# not hold a cursor or a transaction on the db server.
+HISTORY_CHUNK_SIZE = 4000
+
+# Send history chunks to the logs handler.
+# If the queue of its client is full, we do not wait: the logs handler
+# asks us to pause, and return False. The dump will be continued with
+# the same chunks iterator when the logs handler resumes it (see
+# BlockingTasksService), thus the blocking thread may process other
+# tasks meanwhile. Return True when the dump is complete.
+# note: the logs handler is already buffering realtime logs, and
+# records received before (those with an id lower or equal to
+# params['max_id']) are committed. Newer records will be sent from
+# its buffer.
+def stream_db_logs(logs_handler, chunks, history_id):
+    for records in chunks:
+        if logs_handler.write_history_chunk(records) == False:
             break
-    # delete server cursor
-    db.delete_server_cursor(cursor_name)
+        # let a slow client consume its data before we send more
+        if logs_handler.pause_history(history_id):
+            return False
     # notify history dump is complete
     logs_handler.notify_history_processed()
+    return True
+
+def get_db_logs_pages(db, **params):
+    position = None
+    while True:
+        records = db.get_logs_page(position, HISTORY_CHUNK_SIZE, **params)
+        db.commit()
+        if len(records) > 0:
+            yield records
+        if len(records) < HISTORY_CHUNK_SIZE:
+            return
+        position = get_next_position(position, records)
+
+# return the (timestamp, stream_id, ordinal) key of the record
+# following these records
+def get_next_position(position, records):
+    stream_id, timestamp = records[-1][:2]
+    ordinal = 0
+    for record in reversed(records):
+        if record[:2] != (stream_id, timestamp):
+            break
+        ordinal += 1
+    if ordinal == len(records) and position is not None and \
+            position[:2] == (timestamp, stream_id):
+        ordinal += position[2]
+    return timestamp, stream_id, ordinal
+
+# records of the logs archive (see logsarchive.py) are merged with
+# those of the db, in the same order.
+def get_history_chunks(db, **params):
+    chunks = db.get_archived_logs_chunks(**params)
+    db.commit()
+    pages = get_db_logs_pages(db, **params)
+    if len(chunks) == 0:
+        yield from pages
+        return
+    records = merge(iter_archived_logs(chunks, **params),
+                    chain.from_iterable(pages),
+                    key = itemgetter(1, 0))
+    while True:
+        chunk = tuple(islice(records, HISTORY_CHUNK_SIZE))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+# count the records matching logline_regexp, in the db and in the archive
+def count_db_logs(db, logline_regexp, **params):
+    regexp = re.compile(logline_regexp)
+    return sum(1 for records in get_history_chunks(db,
+                                    logline_regexp = logline_regexp, **params) \
+                 for record in records if regexp.search(record[2]))
+
+# Retention of logs may be configured in section "logs" of server.conf:
+# "retention": {
+#     "max-age-days": 90,
+#     "streams": [
+#         { "stream": "^netconsole$", "max-age-days": 7 },
+#         { "stream": "^trace\.", "max-rows": 1000000 }
+#     ]
+# }
+# "max-age-days" applies to all logs. Rules of "streams" apply to the
+# log streams whose name matches the regular expression "stream".
+# "max-rows" limits the records kept in the database: archived records
+# (see logsarchive.py) do not count, and are only removed by age.
+# Logs of forgotten devices are always deleted.
+# Old logs are deleted by the logs writer thread, with its own db
+# connection (see prune_db_logs()), thus writing new records is
+# delayed while deleting. For this reason, records are deleted by
+# small chunks, and a run stops after LOGS_PRUNE_MAX_DURATION seconds
+# (the main thread plans another one if needed).
+LOGS_RETENTION = ((conf or {}).get('logs', {})).get('retention', {})
+LOGS_PRUNE_CHUNK_SIZE = 1000
+LOGS_PRUNE_MAX_DURATION = 0.2
+
+def get_retention_rules():
+    rules = []
+    for rule in LOGS_RETENTION.get('streams', ()):
+        rules.append((re.compile(rule['stream']),
+                      rule.get('max-age-days'), rule.get('max-rows')))
+    return rules
+
+# compute the date before which logs of this stream should be deleted
+def get_stream_limit(db, stream, rules, now):
+    limits = []
+    max_age_days = LOGS_RETENTION.get('max-age-days')
+    if max_age_days is not None:
+        limits.append(now - timedelta(days = max_age_days))
+    for stream_re, max_age_days, max_rows in rules:
+        if not stream_re.search(stream.name):
+            continue
+        if max_age_days is not None:
+            limits.append(now - timedelta(days = max_age_days))
+        if max_rows is not None:
+            limit = db.get_logs_rows_limit(stream.id, max_rows)
+            if limit is not None:
+                limits.append(limit)
+    return max(limits, default = None)
+
+# return False if we had to stop before all records were deleted
+def delete_stream_logs(db, stream_id, before, deadline):
+    while True:
+        deleted, done = db.delete_logs_chunk(
+                            stream_id, before, LOGS_PRUNE_CHUNK_SIZE)
+        if done:
+            return True
+        if time.time() > deadline:
+            return False
+
+# legacy records of a stream without a timestamp
+def delete_untimed_stream_logs(db, stream_id, deadline):
+    while not db.delete_untimed_logs_chunk(stream_id, LOGS_PRUNE_CHUNK_SIZE):
+        if time.time() > deadline:
+            return False
+    return True
+
+# delete logs according to the retention policy.
+# return True if the work is not complete.
+# if limits is given, the date before which logs were deleted is
+# recorded there, for each stream whose pruning is complete.
+def prune_db_logs(db, limits = None):
+    deadline = time.time() + LOGS_PRUNE_MAX_DURATION
+    # logs of forgotten devices
+    for stream in db.select('logstreams', forgotten = True):
+        if not delete_stream_logs(db, stream.id, datetime.max, deadline) or \
+           not delete_untimed_stream_logs(db, stream.id, deadline):
+            return True
+        # if this fails, next streams are pruned anyway
+        db.delete_logstream(stream.id)
+    now = datetime.now()
+    max_age_days = LOGS_RETENTION.get('max-age-days')
+    if max_age_days is not None:
+        # drop whole partitions and archive chunks first, this is fast
+        before = now - timedelta(days = max_age_days)
+        db.drop_logs_partitions(before)
+        drop_archived_logs(db, before)
+    rules = get_retention_rules()
+    if max_age_days is None and len(rules) == 0:
+        return False
+    for stream in db.select('logstreams', forgotten = False):
+        before = get_stream_limit(db, stream, rules, now)
+        if before is None:
+            continue
+        if not delete_stream_logs(db, stream.id, before, deadline):
+            return True
+        if limits is not None:
+            limits[stream.id] = before
+    return False
+
+# index existing partitions of the logs table (see
+# db.setup_logs_pages_index()), one partition per call.
+# return True if the work is not complete.
+def index_db_logs(db):
+    partition = db.get_unindexed_logs_partition()
+    if partition is None:
+        return False
+    db.build_logs_partition_index(partition)
+    return True
 
+# move old logs to the archive, one daily partition per call.
+# return True if the work is not complete.
+def archive_db_logs(db):
+    after_days = LOGS_ARCHIVE.get('after-days')
+    if after_days is None:
+        return False
+    partitions = db.get_archivable_logs_partitions(
+                        datetime.now() - timedelta(days = after_days))
+    if len(partitions) == 0:
+        return False
+    partition, day = partitions[0]
+    archive_logs_partition(db, partition, day)
+    return len(partitions) > 1
@@ -1,13 +1,32 @@
+import itertools
 from walt.common.thread import EvThread, RPCThreadConnector
 from walt.server.threads.blocking.images.clone import clone
 from walt.server.threads.blocking.images.publish import publish
 from walt.server.threads.blocking.images.metadata import update_hub_metadata
 from walt.server.threads.blocking.images.search import search
-from walt.server.threads.blocking.logs import stream_db_logs
+from walt.server.threads.blocking.logs import stream_db_logs, count_db_logs, \
+                                             archive_db_logs, index_db_logs, \
+                                             get_history_chunks
+from walt.server.threads.main.db import ServerDB
 
 class BlockingTasksService(object):
     def __init__(self, server):
         self.server = server
+        # db connection used to retrieve, delete or archive logs
+        # (created on first need)
+        self.logs_db = None
+        # history dumps paused because the client is slow
+        # (see walt.server.threads.blocking.logs.stream_db_logs())
+        self.history_ids = itertools.count()
+        self.paused_histories = {}
+        # while we wait for the result of pause_history(), we may
+        # already receive the resume_db_logs() request
+        self.resumed_histories = set()
+
+    def get_logs_db(self):
+        if self.logs_db is None:
+            self.logs_db = ServerDB()
+        return self.logs_db
 
     def clone_image(self, context, *args, **kwargs):
         res = clone(context.requester.sync, self.server, *args, **kwargs)
@@ -26,9 +45,38 @@ class BlockingTasksService(object):
         context.task.return_result(res)
 
     def stream_db_logs(self, context, **params):
-        res = stream_db_logs(self.server.db, context.requester.sync, **params)
+        chunks = get_history_chunks(self.get_logs_db(), **params)
+        self.continue_db_logs(context, chunks, next(self.history_ids))
+
+    def resume_db_logs(self, context, history_id):
+        paused = self.paused_histories.pop(history_id, None)
+        if paused is None:
+            self.resumed_histories.add(history_id)
+        else:
+            stream_context, chunks = paused
+            self.continue_db_logs(stream_context, chunks, history_id)
+        context.task.return_result(None)
+
+    # the result of the stream_db_logs() call is returned when the
+    # history dump is complete
+    def continue_db_logs(self, context, chunks, history_id):
+        while not stream_db_logs(context.requester.sync, chunks, history_id):
+            if history_id in self.resumed_histories:
+                self.resumed_histories.discard(history_id)
+                continue
+            self.paused_histories[history_id] = (context, chunks)
+            return
+        context.task.return_result(None)
+
+    def count_logs(self, context, **params):
+        res = count_db_logs(self.get_logs_db(), **params)
         context.task.return_result(res)
 
+    def archive_logs(self, context):
+        logs_db = self.get_logs_db()
+        incomplete = index_db_logs(logs_db) or archive_db_logs(logs_db)
+        context.task.return_result(incomplete)
+
     def pull_image(self, context, image_fullname):
         res = self.server.docker.hub.pull(image_fullname)
         context.task.return_result(res)
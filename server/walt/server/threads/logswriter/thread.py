@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from psycopg2 import OperationalError
+from walt.common.thread import EvThread, RPCThreadConnector
+from walt.server.threads.blocking.logs import prune_db_logs
+from walt.server.threads.main.db import ServerDB
+
+# Log records are written to the database by this thread, with its
+# own db connection, in order to keep the main thread responsive
+# when the database is slow (e.g. during vacuum or checkpoints).
+# The main thread appends batches of records to a queue, and
+# notifies us with a call to write_batch() for each of them.
+# Invalid records are isolated and dropped by db.insert_logs().
+# Other failures may be transient (e.g. a lock timeout or a
+# deadlock), thus the batch is written again,
+# at most LOGS_WRITE_MAX_ATTEMPTS times.
+LOGS_WRITE_MAX_ATTEMPTS = 5
+LOGS_WRITE_RETRY_DELAY  = 1.0
+
+class LogsWriterService(object):
+    def __init__(self, db, batches):
+        self.db = db
+        self.batches = batches
+
+    def write_batch(self, context):
+        try:
+            records = self.batches.popleft()
+        except IndexError:
+            # written by the main thread at shutdown
+            context.task.return_result(0)
+            return
+        attempt = 1
+        while True:
+            try:
+                inserted = self.db.insert_logs(records)
+                self.db.commit()
+                break
+            except OperationalError as e:
+                # next attempts should not fail because
+                # of an aborted transaction
+                self.db.rollback_logs()
+                if attempt == LOGS_WRITE_MAX_ATTEMPTS:
+                    raise
+                print('Writing %d log records failed (attempt %d): %s' % \
+                        (len(records), attempt, str(e).splitlines()[0]))
+                attempt += 1
+                time.sleep(LOGS_WRITE_RETRY_DELAY)
+            except Exception:
+                # the batch is lost, but next ones should not fail
+                # because of an aborted transaction.
+                self.db.rollback_logs()
+                raise
+        context.task.return_result(inserted)
+
+    # at shutdown, write batches still queued
+    def cleanup(self):
+        while len(self.batches) > 0:
+            try:
+                records = self.batches.popleft()
+            except IndexError:
+                break
+            self.db.insert_logs(records)
+        self.db.commit()
+
+    # old logs and logs of forgotten devices are deleted here, not
+    # in the blocking thread: deleting holds row locks and competes
+    # with our inserts anyway, and tasks of the blocking thread
+    # (e.g. image pulls) should not be delayed.
+    # see prune_db_logs() about the returned limits.
+    def prune_logs(self, context):
+        limits = {}
+        try:
+            incomplete = prune_db_logs(self.db, limits)
+        except Exception:
+            # next batches should not fail because
+            # of an aborted transaction.
+            self.db.rollback_logs()
+            raise
+        context.task.return_result((incomplete, limits))
+
+    # batches are processed in order, thus when the main thread
+    # gets the result of this call, previous batches are committed.
+    def wait_pending_writes(self, context):
+        context.task.return_result(True)
+
+class ServerLogsWriterThread(EvThread):
+    def __init__(self, tman):
+        EvThread.__init__(self, tman, 'server-logs-writer')
+        self.db = ServerDB()
+        self.batches = deque()
+        self.service = LogsWriterService(self.db, self.batches)
+        self.main = RPCThreadConnector(self.service)
+
+    def prepare(self):
+        self.register_listener(self.main)
+        self.db.commit_stats.join_event_loop(self.ev_loop)
+
+    def cleanup(self):
+        self.service.cleanup()
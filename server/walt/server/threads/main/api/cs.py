@@ -118,7 +118,7 @@ class CSAPI(APISession):
 
     @api_expose_method
     def count_logs(self, context, **kwargs):
-        return context.server.count_logs(**kwargs)
+        return context.server.count_logs(context.task, **kwargs)
 
     @api_expose_method
     def forget(self, context, device_name):
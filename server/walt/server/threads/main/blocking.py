@@ -30,8 +30,17 @@ class BlockingTasksManager(RPCThreadConnector):
     def pull_image(self, image_fullname, result_cb):
         self.m_async.pull_image(image_fullname).then(result_cb)
 
+    def archive_logs(self, result_cb):
+        self.m_async.archive_logs().then(result_cb)
+
+    def count_logs(self, result_cb, **params):
+        self.m_async.count_logs(**params).then(result_cb)
+
     def stream_db_logs(self, logs_handler):
         # request the blocking task to stream db logs
         self.session(logs_handler).m_async.stream_db_logs(
                             **logs_handler.params)
 
+    def resume_db_logs(self, history_id):
+        self.m_async.resume_db_logs(history_id)
+
@@ -1,15 +1,268 @@
 #!/usr/bin/env python
+from walt.server import conf
 from walt.server.postgres import PostgresDB
+from walt.server.tools import PeriodicStats
+from psycopg2 import DataError, IntegrityError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+from datetime import date, datetime, timedelta
+from io import StringIO
 from time import time
+import re
 
 EV_AUTO_COMMIT              = 0
 EV_AUTO_COMMIT_PERIOD       = 2
+EV_LOGS_PARTITIONS          = 1
+EV_LOGS_PARTITIONS_PERIOD   = 3600
+
+# The logs table is partitioned by day. We always create
+# partitions a few days in advance.
+LOGS_PARTITIONS_DAYS_AHEAD  = 3
+LOGS_PARTITION_NAME_FORMAT  = 'logs_%Y%m%d'
+PG_MIN_SERVER_VERSION       = 110000
+# Log records are identified by an id, in the order of their reception
+# (see LogsToDBHandler). Ids are allocated by blocks, in order to avoid
+# a query per record.
+LOGS_ID_BLOCK_SIZE          = 10000
+# Order of log records in history dumps and archives. Records written
+# by older versions have no id, they are ordered by physical location
+# (ctid) among those with the same timestamp and stream_id.
+LOGS_ORDERING               = 'l.timestamp, l.stream_id, l.id, l.ctid'
+# index matching LOGS_ORDERING (see setup_logs_pages_index())
+LOGS_PAGES_INDEX            = 'logs_timestamp_stream_id_id_idx'
+
+# postgresql text values cannot contain NUL chars, we replace them
+NUL_REPLACEMENT = '\ufffd'
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+    '\0': NUL_REPLACEMENT })
+
+# escape special chars of a value sent in COPY text format
+def copy_escape(s):
+    return s.translate(COPY_ESCAPES)
+
+# Python regular expressions are mostly compatible with postgresql
+# 'advanced regular expressions', but not fully.
+# This function converts a python regexp to a postgresql regexp which
+# matches at least all the lines the python regexp matches: it is only
+# used to let postgresql discard lines which cannot match, and the
+# python regexp is still applied to the remaining lines.
+# Constructs whose semantics differ (e.g. \w, \d, \b depend on the
+# locale of the db server) are replaced by a broader expression, and
+# None is returned if the regexp uses constructs we cannot convert
+# safely. If postgresql still rejects the result, the query is run
+# again without this filter (see ServerDB.get_logs_page()).
+PG_REGEXP_ANY_CHAR_ESCAPES = 'dDsSwW'
+PG_REGEXP_EMPTY_ESCAPES = 'bB'
+PG_REGEXP_SAME_ESCAPES = { 'A': '^', 'Z': '$', 'n': r'\n', 't': r'\t',
+                           'r': r'\r', 'f': r'\f', 'v': r'\v' }
+PG_REGEXP_BOUND = re.compile(r'\{(\d*)(,?)(\d*)\}')
+PG_REGEXP_MAX_BOUND = 255
+PG_REGEXP_GROUP = re.compile(r'\((?:\?(?:P<\w+>|P=\w+\)|[:=!#]|<[=!])?)?')
+PG_REGEXP_CLASS = re.compile(r'\[\^?\]?(?:[^\\\]\[]|\\[^a-zA-Z0-9])*\]')
+
+# return the position following the char class starting at pos
+# (or None if it contains '[', which may be special in postgresql)
+def get_class_end(pattern, pos):
+    pos += 1
+    if pattern[pos:pos+1] == '^':
+        pos += 1
+    if pattern[pos:pos+1] == ']':
+        pos += 1
+    while pos < len(pattern):
+        c = pattern[pos]
+        if c == ']':
+            return pos + 1
+        elif c == '[':
+            return None
+        pos += 2 if c == '\\' else 1
+    return None
+
+def pg_regexp(pattern):
+    res = []
+    # for each open group, True if its content is dropped
+    groups = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        out = None
+        if c == '\\':
+            if i+1 == len(pattern):
+                return None
+            c = pattern[i+1]
+            i += 2
+            if c in PG_REGEXP_ANY_CHAR_ESCAPES:
+                out = '.'
+            elif c in PG_REGEXP_EMPTY_ESCAPES:
+                out = ''
+            elif c in PG_REGEXP_SAME_ESCAPES:
+                out = PG_REGEXP_SAME_ESCAPES[c]
+            elif c.isdigit() and c != '0':
+                out = '(?:.*)'  # back reference
+                while i < len(pattern) and pattern[i].isdigit():
+                    i += 1
+            elif c.isalnum() or not c.isprintable():
+                return None
+            else:
+                out = '\\' + c
+        elif c == '[':
+            m = PG_REGEXP_CLASS.match(pattern, i)
+            if m is not None:
+                out, i = m.group(), m.end()
+            else:
+                # class with escapes such as \d or \x20: we replace it
+                # with any char.
+                i = get_class_end(pattern, i)
+                if i is None:
+                    return None
+                out = '.'
+        elif c == '(':
+            m = PG_REGEXP_GROUP.match(pattern, i)
+            if m.group() == '(?' or m.group() == '(?P':
+                return None     # flags, atomic or conditional group, etc.
+            i = m.end()
+            if m.group().startswith('(?P='):
+                out = '(?:.*)'  # back reference
+            else:
+                dropped = m.group() in ('(?=', '(?!', '(?<=', '(?<!', '(?#')
+                groups.append(dropped)
+                if dropped:
+                    out = ''
+                elif m.group() == '(?:':
+                    out = '(?:'
+                else:
+                    out = '('
+        elif c == ')':
+            if len(groups) == 0:
+                return None
+            i += 1
+            out = '' if groups.pop() else ')'
+        elif c == '{':
+            m = PG_REGEXP_BOUND.match(pattern, i)
+            if m is None or m.group() == '{}':
+                out, i = r'\{', i + 1    # literal char
+            else:
+                low, comma, high = m.groups()
+                i = m.end()
+                if (high == '' and comma == ',') or \
+                        max(int(low or 0), int(high or 0)) > PG_REGEXP_MAX_BOUND:
+                    out = '*'
+                else:
+                    out = '{%s%s%s}' % (low or '0', comma, high)
+                if pattern[i:i+1] == '+':
+                    return None     # possessive quantifier
+        elif c == '}':
+            out, i = r'\}', i + 1
+        elif c == '$':
+            # also matches before a final newline in python
+            out, i = r'\n?$', i + 1
+        else:
+            if c in '*+?' and pattern[i+1:i+2] == '+':
+                return None     # possessive quantifier
+            out, i = c, i + 1
+        if True not in groups:
+            res.append(out)
+    if len(groups) > 0:
+        return None
+    return ''.join(res)
+
+# Optional storage of log lines as templates, enabled by setting
+# "storage": "templates" in section "logs" of server.conf.
+# Variable parts of a line (numbers, hexadecimal values) are replaced
+# by '%s' to get its template. When a template recurs in a stream, it
+# is recorded in table logs_templates, and next lines with this template
+# are stored as a template id and the list of variable parts (column
+# params, joined with PARAMS_SEPARATOR), instead of the full line.
+# Lines are reconstructed by postgresql with format() (see LOGS_LINE).
+LOGS_STORAGE = ((conf or {}).get('logs', {})).get('storage', 'plain')
+TEMPLATE_VARIABLE = re.compile(r'0x[0-9a-fA-F]+|\d+(?:[.:,]\d+)*')
+PARAMS_SEPARATOR = '\x1f'
+TEMPLATE_MIN_OCCURRENCES = 2
+TEMPLATES_MAX_PER_STREAM = 1000
+TEMPLATES_MAX_CANDIDATES = 100000
+
+LOGS_LINE = """coalesce(l.line,
+        format(t.template, VARIADIC string_to_array(l.params, E'\\x1f')))"""
+LOGS_TEMPLATES_JOIN = 'LEFT JOIN logs_templates t ON t.id = l.template_id'
+
+class LogTemplates(object):
+    def __init__(self, db):
+        self.db = db
+        # (stream_id, template) -> template id
+        self.ids = {}
+        self.num_templates = {}     # stream_id -> number of templates
+        # (stream_id, template) -> number of occurrences, for
+        # templates not recorded yet
+        self.candidates = {}
+        for row in db.select('logs_templates'):
+            self.add(row.id, row.stream_id, row.template)
+
+    def add(self, template_id, stream_id, template):
+        self.ids[(stream_id, template)] = template_id
+        self.num_templates[stream_id] = self.num_templates.get(stream_id, 0) + 1
+
+    # return (template_id, params), or None if the line should
+    # be stored as is.
+    def encode(self, stream_id, line):
+        template = TEMPLATE_VARIABLE.sub('%s', line.replace('%', '%%'))
+        key = (stream_id, template)
+        template_id = self.ids.get(key)
+        if template_id is None:
+            occurrences = self.candidates.get(key, 0) + 1
+            if occurrences < TEMPLATE_MIN_OCCURRENCES or \
+                    self.num_templates.get(stream_id, 0) >= TEMPLATES_MAX_PER_STREAM:
+                if len(self.candidates) >= TEMPLATES_MAX_CANDIDATES:
+                    self.candidates = {}
+                self.candidates[key] = occurrences
+                return None
+            del self.candidates[key]
+            # (written with the log records, thus the transaction
+            # is not marked dirty, see ServerDB.commit())
+            self.db.c.execute("""INSERT INTO logs_templates(stream_id, template)
+                                VALUES (%s, %s) RETURNING id;""",
+                                (stream_id, template))
+            template_id = self.db.c.fetchone().id
+            self.add(template_id, stream_id, template)
+        return template_id, PARAMS_SEPARATOR.join(TEMPLATE_VARIABLE.findall(line))
+
+class CommitStats(PeriodicStats):
+    LABEL = 'db commits'
+
+    def reset(self):
+        self.commits = 0
+        self.skipped = 0
+        self.log_records = 0
+        self.latency_total = 0
+        self.latency_max = 0
+
+    def record_commit(self, latency, log_records):
+        self.commits += 1
+        self.log_records += log_records
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def is_empty(self):
+        return self.commits == 0
+
+    def __str__(self):
+        return ('%d commits (%d skipped), %d log records (%d per commit), ' + \
+                'latency avg %.1fms max %.1fms') % (
+                    self.commits, self.skipped, self.log_records,
+                    self.log_records / self.commits,
+                    self.latency_total / self.commits * 1000,
+                    self.latency_max * 1000)
 
 class ServerDB(PostgresDB):
 
     def __init__(self):
         # parent constructor
         PostgresDB.__init__(self)
+        # number of log records written in current transaction
+        self.pending_log_records = 0
+        self.commit_stats = CommitStats()
+        # see LogTemplates (created on first need)
+        self.logs_storage = LOGS_STORAGE
+        self.logs_templates = None
         # create the db schema
         self.execute("""CREATE TABLE IF NOT EXISTS devices (
                     mac TEXT PRIMARY KEY,
@@ -44,11 +297,17 @@ class ServerDB(PostgresDB):
         self.execute("""CREATE TABLE IF NOT EXISTS logstreams (
                     id SERIAL PRIMARY KEY,
                     sender_mac TEXT REFERENCES devices(mac),
-                    name TEXT);""")
-        self.execute("""CREATE TABLE IF NOT EXISTS logs (
-                    stream_id INTEGER REFERENCES logstreams(id),
-                    timestamp TIMESTAMP,
-                    line TEXT);""")
+                    name TEXT,
+                    forgotten BOOLEAN DEFAULT FALSE);""")
+        # (column added after the first versions of this table)
+        if not self.has_column('logstreams', 'forgotten'):
+            self.execute("""ALTER TABLE logstreams
+                        ADD COLUMN forgotten BOOLEAN DEFAULT FALSE;""")
+        self.setup_logs_table()
+        self.setup_logs_id_sequence()
+        self.setup_logs_counts_table()
+        self.setup_logs_templates_table()
+        self.setup_logs_archive_table()
         self.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
                     username TEXT,
                     timestamp TIMESTAMP,
@@ -65,23 +324,471 @@ class ServerDB(PostgresDB):
             ev_type = EV_AUTO_COMMIT
         )
 
+    # Commits of transactions which only wrote logs do not wait for
+    # data to be flushed to disk: in case of a crash, we may lose the
+    # last log records, but the database remains consistent.
+    # Other transactions (devices, nodes, topology, etc.) remain durable.
+    # Log records are written with the cursor directly (see insert_logs()),
+    # thus only other writes mark the transaction dirty.
+    def commit(self):
+        if self.conn.info.transaction_status == TRANSACTION_STATUS_IDLE:
+            self.commit_stats.skipped += 1
+            return  # nothing to commit
+        if self.pending_log_records > 0 and not self.dirty:
+            self.c.execute('SET LOCAL synchronous_commit TO OFF;')
+        t0 = time()
+        PostgresDB.commit(self)
+        self.commit_stats.record_commit(time() - t0, self.pending_log_records)
+        self.pending_log_records = 0
+
+    def plan_logs_maintenance(self, ev_loop):
+        ev_loop.plan_event(
+            ts = time(),
+            target = self,
+            repeat_delay = EV_LOGS_PARTITIONS_PERIOD,
+            ev_type = EV_LOGS_PARTITIONS
+        )
+
     def handle_planned_event(self, ev_type):
-        assert(ev_type == EV_AUTO_COMMIT)
+        if ev_type == EV_AUTO_COMMIT:
+            self.commit()
+        elif ev_type == EV_LOGS_PARTITIONS:
+            self.ensure_logs_partitions()
+
+    # note: 'ALTER TABLE ... ADD COLUMN IF NOT EXISTS' would lock the
+    # table even if the column exists, and several threads open a
+    # connection to the database at startup.
+    def has_column(self, table, column):
+        self.execute("""SELECT 1 FROM information_schema.columns
+                        WHERE table_name = %s AND column_name = %s;""",
+                        (table, column))
+        return self.c.fetchone() is not None
+
+    def get_table_kind(self, table):
+        self.execute("""SELECT relkind FROM pg_class
+                        WHERE oid = to_regclass(%s);""", (table,))
+        res = self.c.fetchone()
+        if res is None:
+            return None
+        return res.relkind
+
+    # The logs table is range-partitioned on timestamp (one partition
+    # per day), which allows history queries to consider only the
+    # relevant partitions, and old logs to be removed by dropping
+    # partitions.
+    # Older versions of walt used a plain table: in this case, we
+    # attach it as a 'legacy' partition holding everything before today
+    # (rows with no timestamp cannot be partitioned, they are discarded).
+    # Note: partitioning the logs table requires postgresql >= 11
+    # (default partitions, indexes and foreign keys on partitioned tables).
+    def setup_logs_table(self):
+        kind = self.get_table_kind('logs')
+        if kind != 'p' and self.conn.server_version < PG_MIN_SERVER_VERSION:
+            raise RuntimeError('PostgreSQL >= 11 is required (found version %d).' % \
+                                self.conn.server_version)
+        if kind == 'p':
+            # (columns added after the first partitioned versions)
+            if not self.has_column('logs', 'template_id'):
+                self.execute("""ALTER TABLE logs
+                                ADD COLUMN template_id INTEGER,
+                                ADD COLUMN params TEXT;""")
+            if not self.has_column('logs', 'id'):
+                self.execute('ALTER TABLE logs ADD COLUMN id BIGINT;')
+            self.setup_logs_pages_index()
+            self.ensure_logs_partitions()
+            return
+        if kind is not None:
+            self.execute('ALTER TABLE logs RENAME TO logs_legacy;')
+        self.execute("""CREATE TABLE logs (
+                    stream_id INTEGER REFERENCES logstreams(id),
+                    timestamp TIMESTAMP,
+                    line TEXT,
+                    template_id INTEGER,
+                    params TEXT,
+                    id BIGINT) PARTITION BY RANGE (timestamp);""")
+        # rows whose timestamp does not match any daily partition
+        # (e.g. node with a wrong clock) will be stored here.
+        self.execute('CREATE TABLE logs_default PARTITION OF logs DEFAULT;')
+        self.execute("""CREATE INDEX logs_stream_id_timestamp_idx
+                        ON logs (stream_id, timestamp);""")
+        self.setup_logs_pages_index()
+        self.ensure_logs_partitions()
+        if kind is not None:
+            # rows with a NULL timestamp cannot be part of a range
+            # partition, they are moved to the default partition.
+            today = datetime.combine(date.today(), datetime.min.time())
+            self.execute("""
+                WITH moved AS (
+                    DELETE FROM logs_legacy
+                    WHERE timestamp >= %s OR timestamp IS NULL
+                    RETURNING *)
+                INSERT INTO logs SELECT * FROM moved;""", (today,))
+            self.execute("""ALTER TABLE logs_legacy
+                            ADD COLUMN template_id INTEGER,
+                            ADD COLUMN params TEXT,
+                            ADD COLUMN id BIGINT;""")
+            self.execute("""ALTER TABLE logs ATTACH PARTITION logs_legacy
+                        FOR VALUES FROM (MINVALUE) TO (%s);""", (today,))
+        self.commit()
+
+    # Index used to retrieve history by pages (see get_logs_page()).
+    # Building it on existing partitions would lock the logs table
+    # for a long time, thus we only create the index of the logs table
+    # here (partitions created later get theirs automatically), and
+    # existing partitions are indexed in the background, without
+    # locking them (see build_logs_partition_index()). Until this is
+    # complete, history queries are slower.
+    def setup_logs_pages_index(self):
+        if self.get_table_kind(LOGS_PAGES_INDEX) is None:
+            self.execute("""CREATE INDEX %s ON ONLY logs
+                            (timestamp, stream_id, id);""" % LOGS_PAGES_INDEX)
+
+    # return the name of a partition not indexed yet, or None
+    def get_unindexed_logs_partition(self):
+        self.execute("""
+            SELECT c.relname as name
+            FROM pg_inherits i, pg_class c
+            WHERE i.inhparent = 'logs'::regclass AND c.oid = i.inhrelid
+              AND NOT EXISTS (
+                SELECT 1 FROM pg_inherits ii, pg_index x
+                WHERE ii.inhparent = %s::regclass
+                  AND x.indexrelid = ii.inhrelid AND x.indrelid = c.oid)
+            LIMIT 1;""", (LOGS_PAGES_INDEX,))
+        row = self.c.fetchone()
+        self.commit()
+        return None if row is None else row.name
+
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    def build_logs_partition_index(self, partition):
+        name = partition + '_pages_idx'
+        # (the index may be invalid, if a previous build was interrupted)
+        self.execute('DROP INDEX IF EXISTS %s;' % name)
+        self.commit()
+        self.conn.autocommit = True
+        try:
+            self.c.execute("""CREATE INDEX CONCURRENTLY %s ON %s
+                            (timestamp, stream_id, id);""" % (name, partition))
+        finally:
+            self.conn.autocommit = False
+        self.execute('ALTER INDEX %s ATTACH PARTITION %s;' % \
+                        (LOGS_PAGES_INDEX, name))
+        self.commit()
+
+    # (records written by older versions have no id)
+    def setup_logs_id_sequence(self):
+        self.execute("""CREATE SEQUENCE IF NOT EXISTS logs_id_seq
+                        INCREMENT BY %d;""" % LOGS_ID_BLOCK_SIZE)
+        self.commit()
+
+    # Return the range of ids of a new block (see LOGS_ID_BLOCK_SIZE).
+    # (sequences are not transactional, thus the transaction is not
+    # marked as dirty)
+    def allocate_logs_ids(self):
+        self.c.execute("SELECT nextval('logs_id_seq') AS first;")
+        first = self.c.fetchone().first
+        return range(first, first + LOGS_ID_BLOCK_SIZE)
+
+    # In order to quickly estimate the number of logs matching a query,
+    # we maintain the number of log records of each stream per minute.
+    # For compatibility with format_logs_query(), the column holding the
+    # start of the minute is named 'timestamp'.
+    def setup_logs_counts_table(self):
+        if self.get_table_kind('logs_counts') is not None:
+            return
+        self.execute("""CREATE TABLE logs_counts (
+                    stream_id INTEGER REFERENCES logstreams(id),
+                    timestamp TIMESTAMP,
+                    count INTEGER,
+                    PRIMARY KEY (stream_id, timestamp));""")
+        # initialize with the logs we already have
+        self.execute("""INSERT INTO logs_counts
+                    SELECT stream_id, date_trunc('minute', timestamp), count(*)
+                    FROM logs WHERE timestamp IS NOT NULL GROUP BY 1, 2;""")
+        self.commit()
+
+    # see LogTemplates
+    def setup_logs_templates_table(self):
+        self.execute("""CREATE TABLE IF NOT EXISTS logs_templates (
+                    id SERIAL PRIMARY KEY,
+                    stream_id INTEGER REFERENCES logstreams(id),
+                    template TEXT);""")
+        # if templates were stored, queries must reconstruct lines
+        # (even if this storage mode was disabled since then)
+        self.execute('SELECT EXISTS (SELECT 1 FROM logs_templates);')
+        self.logs_templates_used = self.c.fetchone()[0] or \
+                                   self.logs_storage == 'templates'
+        self.commit()
+
+    # index of the chunks of the logs archive (see logsarchive.py)
+    def setup_logs_archive_table(self):
+        self.execute("""CREATE TABLE IF NOT EXISTS logs_archive (
+                    name TEXT PRIMARY KEY,
+                    day DATE,
+                    min_ts TIMESTAMP,
+                    max_ts TIMESTAMP,
+                    stream_ids INTEGER[],
+                    num_records INTEGER);""")
+        self.commit()
+
+    def get_logs_partitions(self):
+        self.execute("""
+            SELECT c.relname as name,
+                   pg_get_expr(c.relpartbound, c.oid) as bound
+            FROM pg_inherits i, pg_class c
+            WHERE i.inhparent = 'logs'::regclass AND c.oid = i.inhrelid;""")
+        return self.c.fetchall()
+
+    def ensure_logs_partitions(self):
+        existing = set(p.name for p in self.get_logs_partitions())
+        today = datetime.combine(date.today(), datetime.min.time())
+        days = [ today + timedelta(days=i) \
+                 for i in range(LOGS_PARTITIONS_DAYS_AHEAD + 1) ]
+        # rows of past days without a partition (e.g. sent by a node with
+        # a wrong clock) were stored in the default partition. We create
+        # the partitions of these days too, for their rows to be handled
+        # by retention and archiving.
+        self.execute("""SELECT DISTINCT date_trunc('day', timestamp) AS day
+                        FROM logs_default WHERE timestamp < %s;""", (today,))
+        days += [ row.day for row in self.c.fetchall() ]
+        for start in days:
+            end = start + timedelta(days=1)
+            name = start.strftime(LOGS_PARTITION_NAME_FORMAT)
+            if name in existing:
+                continue
+            # if rows of this day were stored in the default partition,
+            # move them to the new partition before attaching it.
+            self.execute("""CREATE TABLE %(name)s (LIKE logs INCLUDING DEFAULTS);
+                WITH moved AS (
+                    DELETE FROM logs_default
+                    WHERE timestamp >= %%(start)s AND timestamp < %%(end)s
+                    RETURNING *)
+                INSERT INTO %(name)s SELECT * FROM moved;
+                ALTER TABLE logs ATTACH PARTITION %(name)s
+                    FOR VALUES FROM (%%(start)s) TO (%%(end)s);""" % dict(name = name),
+                dict(start = start, end = end))
         self.commit()
 
-    def get_logs(self, cursor_name, **kwargs):
-        sql, args = self.format_logs_query('l.*', ordering='l.timestamp', **kwargs)
+    # Remove all logs older than the given datetime, by dropping the
+    # partitions which only contain older logs.
+    # Return the number of partitions dropped.
+    def drop_logs_partitions(self, before):
+        dropped = 0
+        for name, upper in self.get_logs_partitions_before(before):
+            self.execute('DROP TABLE %s;' % name)
+            self.execute('DELETE FROM logs_counts WHERE timestamp < %s;',
+                         (upper,))
+            dropped += 1
+        self.commit()
+        return dropped
+
+    # Return (name, upper bound) of the partitions which only contain
+    # logs older than the given datetime.
+    def get_logs_partitions_before(self, before):
+        partitions = []
+        for partition in self.get_logs_partitions():
+            m = re.search(r"TO \('([^']*)'\)", partition.bound)
+            if m is None:
+                continue    # default partition
+            upper = datetime.fromisoformat(m.group(1))
+            if upper <= before:
+                partitions.append((partition.name, upper))
+        return partitions
+
+    # Return (name, day) of the daily partitions which only contain
+    # logs older than the given datetime, oldest first.
+    def get_archivable_logs_partitions(self, before):
+        partitions = []
+        for name, upper in self.get_logs_partitions_before(before):
+            try:
+                day = datetime.strptime(name, LOGS_PARTITION_NAME_FORMAT).date()
+            except ValueError:
+                continue    # legacy partition
+            partitions.append((name, day))
+        return sorted(partitions, key = lambda p: p[1])
+
+    def get_partition_logs(self, cursor_name, partition):
+        table = partition + ' l'
+        if self.logs_templates_used:
+            table += ' ' + LOGS_TEMPLATES_JOIN
         cursor = self.server_cursors[cursor_name]
-        cursor.execute(sql, args)
+        cursor.execute("""SELECT l.stream_id, l.timestamp, %s FROM %s
+                          ORDER BY %s;""" % \
+                          (self.get_logs_line(), table, LOGS_ORDERING))
         return cursor
 
-    def count_logs(self, **kwargs):
-        sql, args = self.format_logs_query('count(*)', **kwargs)
+    # Index the archive chunks of a partition, and drop this partition.
+    # chunks must be ArchiveChunkWriter objects (see logsarchive.py).
+    def record_archived_logs_partition(self, partition, day, chunks):
+        execute_values(self.c, """INSERT INTO logs_archive(name, day, min_ts,
+                                        max_ts, stream_ids, num_records)
+                                  VALUES %s;""",
+            tuple((chunk.name, day, chunk.min_ts, chunk.max_ts,
+                   sorted(chunk.stream_ids), chunk.num_records) for chunk in chunks))
+        self.dirty = True
+        self.execute('DROP TABLE %s;' % partition)
+        self.commit()
+
+    # note: history is read and partitions are archived by the blocking
+    # thread, thus a partition cannot be archived while it is being read.
+    def get_archived_logs_chunks(self, history=(None,None), stream_ids=None,
+                                 **kwargs):
+        args = []
+        constraints = []
+        if stream_ids is not None:
+            constraints.append('stream_ids && %s::integer[]')
+            args.append(list(stream_ids))
+        start, end = history
+        if start:
+            constraints.append('max_ts > %s')
+            args.append(start)
+        if end:
+            constraints.append('min_ts < %s')
+            args.append(end)
+        where_clause = self.get_where_clause_from_constraints(constraints)
+        return self.execute('SELECT * FROM logs_archive %s ORDER BY min_ts;' % \
+                            where_clause, args).fetchall()
+
+    # Remove the archive chunks of the days older than the given
+    # datetime from the index, and return their names.
+    def get_archived_logs_chunk_names(self, day):
+        self.execute('SELECT name FROM logs_archive WHERE day = %s;', (day,))
+        return tuple(row.name for row in self.c.fetchall())
+
+    def drop_archived_logs_chunks(self, before):
+        self.execute("""DELETE FROM logs_archive
+                        WHERE day + 1 <= %s::date RETURNING name, day;""",
+                        (before,))
+        rows = self.c.fetchall()
+        if len(rows) > 0:
+            upper = max(row.day for row in rows) + timedelta(days = 1)
+            self.execute('DELETE FROM logs_counts WHERE timestamp < %s;',
+                         (upper,))
+        self.commit()
+        return tuple(row.name for row in rows)
+
+    # Insert a batch of log records using a single COPY statement,
+    # which is much faster than issuing one INSERT per record.
+    # records must be a list of (stream_id, timestamp, line, id) tuples.
+    # If the batch contains invalid records (e.g. a record of a log
+    # stream deleted meanwhile), we bisect it to insert the valid ones.
+    # Returns the number of records inserted.
+    def insert_logs(self, records):
+        # a savepoint allows to discard a failing COPY without
+        # aborting the whole transaction.
+        self.c.execute('SAVEPOINT insert_logs;')
+        try:
+            self.copy_logs(records)
+        except (DataError, IntegrityError) as e:
+            self.c.execute('ROLLBACK TO SAVEPOINT insert_logs;')
+            self.c.execute('RELEASE SAVEPOINT insert_logs;')
+            # templates recorded after the savepoint are lost too
+            self.logs_templates = None
+            if len(records) == 1:
+                stream_id, timestamp = records[0][:2]
+                print('Dropped invalid log record (stream %d, %s): %s' % \
+                        (stream_id, timestamp, str(e).splitlines()[0]))
+                return 0
+            middle = len(records) // 2
+            return self.insert_logs(records[:middle]) + \
+                   self.insert_logs(records[middle:])
+        self.c.execute('RELEASE SAVEPOINT insert_logs;')
+        self.pending_log_records += len(records)
+        return len(records)
+
+    def copy_logs(self, records):
+        buf = StringIO()
+        if self.logs_storage == 'templates':
+            if self.logs_templates is None:
+                self.logs_templates = LogTemplates(self)
+            for stream_id, timestamp, line, log_id in records:
+                line = line.replace('\0', NUL_REPLACEMENT)
+                encoded = self.logs_templates.encode(stream_id, line)
+                if encoded is None:
+                    buf.write('%d\t%s\t%d\t%s\t\\N\t\\N\n' % \
+                            (stream_id, timestamp, log_id, copy_escape(line)))
+                else:
+                    buf.write('%d\t%s\t%d\t\\N\t%d\t%s\n' % \
+                            ((stream_id, timestamp, log_id) + encoded))
+            columns = 'stream_id, timestamp, id, line, template_id, params'
+        else:
+            for stream_id, timestamp, line, log_id in records:
+                buf.write('%d\t%s\t%d\t%s\n' % \
+                        (stream_id, timestamp, log_id, copy_escape(line)))
+            columns = 'stream_id, timestamp, id, line'
+        buf.seek(0)
+        self.c.copy_expert(
+            'COPY logs(%s) FROM STDIN;' % columns, buf)
+        # update the per-minute counts
+        counts = {}
+        for stream_id, timestamp in (record[:2] for record in records):
+            key = (stream_id, timestamp.replace(second = 0, microsecond = 0))
+            counts[key] = counts.get(key, 0) + 1
+        execute_values(self.c, """
+            INSERT INTO logs_counts(stream_id, timestamp, count) VALUES %s
+            ON CONFLICT (stream_id, timestamp)
+            DO UPDATE SET count = logs_counts.count + EXCLUDED.count;""",
+            tuple(key + (count,) for key, count in counts.items()))
+
+    # History is retrieved by pages, ordered by (timestamp, stream_id,
+    # ordinal), where ordinal is the rank of a record among those with
+    # the same timestamp and stream_id, in the order of their ids
+    # (see LOGS_ORDERING).
+    # position is the (timestamp, stream_id, ordinal) key of the first
+    # record to return, or None to start at the beginning of the history
+    # range. No cursor or transaction has to be kept between pages.
+    def get_logs_page(self, position, page_size, **kwargs):
+        projections = 'l.stream_id, l.timestamp, %s' % self.get_logs_line()
+        skip = 0 if position is None else position[2]
+        records = [ tuple(row) for row in self.fetch_logs(projections,
+                                ordering=LOGS_ORDERING,
+                                position=position, limit=page_size + skip,
+                                **kwargs) ]
+        # skip records of the first key already returned
+        # (less of them may remain, if logs were deleted meanwhile)
+        if skip > 0:
+            key = position[1], position[0]
+            first = 0
+            while first < min(skip, len(records)) and records[first][:2] == key:
+                first += 1
+            records = records[first:]
+        return records[:page_size]
+
+    # Run a query built by format_logs_query() and return the rows.
+    # If postgresql rejects the regular expression converted by
+    # pg_regexp(), the query is run again without it (lines are
+    # filtered by the caller anyway).
+    def fetch_logs(self, projections, logline_regexp=None, **kwargs):
+        if logline_regexp:
+            sql, args = self.format_logs_query(projections,
+                                logline_regexp=logline_regexp, **kwargs)
+            self.c.execute('SAVEPOINT logs_query;')
+            try:
+                rows = self.execute(sql, args).fetchall()
+                self.c.execute('RELEASE SAVEPOINT logs_query;')
+                return rows
+            except DataError:
+                self.c.execute('ROLLBACK TO SAVEPOINT logs_query;')
+                self.c.execute('RELEASE SAVEPOINT logs_query;')
+        sql, args = self.format_logs_query(projections, **kwargs)
+        return self.execute(sql, args).fetchall()
+
+    # note: logs matching a regular expression are counted by the blocking
+    # thread (see walt.server.threads.blocking.logs.count_db_logs()).
+    # Here we use the per-minute counts (they include archived logs).
+    # The result is approximate because minutes at the boundaries of
+    # the history range are fully counted.
+    def count_logs(self, history=(None,None), **kwargs):
+        start, end = history
+        if start:
+            start -= timedelta(minutes = 1)
+        sql, args = self.format_logs_query('coalesce(sum(l.count), 0)',
+                                history = (start, end), table = 'logs_counts',
+                                **kwargs)
         return self.execute(sql, args).fetchall()[0][0]
 
     def get_logstream_ids(self, senders):
         if senders == None:
-            return self.select_no_fetch('logstreams')
+            return self.select_no_fetch('logstreams', forgotten = False)
         else:
             sender_names = '''('%s')''' % "','".join(senders)
             sql = """   SELECT s.*
@@ -89,17 +796,28 @@ class ServerDB(PostgresDB):
                         WHERE s.sender_mac = d.mac AND d.name IN %s;""" % sender_names
             return self.execute(sql)
 
+    # compute the ids of the log streams of the given senders,
+    # whose name matches the given regular expression (if any).
+    def get_matching_logstream_ids(self, senders, streams = None):
+        if streams:
+            streams_re = re.compile(streams)
+        else:
+            streams_re = None
+        return list(row.id for row in self.get_logstream_ids(senders) \
+                    if streams_re is None or streams_re.search(row.name))
+
+    # note: stream_ids should be computed by calling
+    # get_matching_logstream_ids() first; if it is None,
+    # logs of all streams are selected.
     def format_logs_query(self, projections, ordering=None, \
-                    senders=None, history=(None,None), stream_ids=None, **kwargs):
+                    history=(None,None), stream_ids=None, logline_regexp=None,
+                    table='logs', position=None, limit=None, max_id=None,
+                    **kwargs):
         args = []
-        constraints = [ 's.sender_mac = d.mac', 'l.stream_id = s.id' ]
-        if stream_ids:
-            stream_ids_sql = '''(%s)''' % ",".join(
-                str(stream_id) for stream_id in stream_ids)
-            constraints.append('s.id IN %s' % stream_ids_sql)
-        if senders:
-            sender_names = '''('%s')''' % "','".join(senders)
-            constraints.append('d.name IN %s' % sender_names)
+        constraints = []
+        if stream_ids is not None:
+            constraints.append('l.stream_id = ANY(%s)')
+            args.append(list(stream_ids))
         start, end = history
         if start:
             constraints.append('l.timestamp > %s')
@@ -107,26 +825,152 @@ class ServerDB(PostgresDB):
         if end:
             constraints.append('l.timestamp < %s')
             args.append(end)
+        if max_id is not None:
+            # records received after max_id (see LogsToSocketHandler)
+            constraints.append('(l.id IS NULL OR l.id <= %s)')
+            args.append(max_id)
+        if position is not None:
+            # see get_logs_page()
+            timestamp, stream_id, ordinal = position
+            constraints.append('l.timestamp >= %s')
+            constraints.append('(l.timestamp, l.stream_id) >= (%s, %s)')
+            args += [ timestamp, timestamp, stream_id ]
+        if logline_regexp:
+            # let postgresql discard lines which cannot match
+            # (lines are still filtered by the caller, see pg_regexp())
+            logline_regexp = pg_regexp(logline_regexp)
+            if logline_regexp is not None:
+                constraints.append('%s ~ %%s' % self.get_logs_line(table))
+                args.append(logline_regexp)
         where_clause = self.get_where_clause_from_constraints(constraints)
         if ordering:
             ordering = 'order by ' + ordering
         else:
             ordering = ''
-        return ("SELECT %s FROM devices d, logstreams s, logs l %s %s;" % \
-                                (projections, where_clause, ordering), args)
+        if limit is not None:
+            ordering += ' limit %d' % limit
+        if table == 'logs' and self.logs_templates_used:
+            table += ' l ' + LOGS_TEMPLATES_JOIN
+        else:
+            table += ' l'
+        return ("SELECT %s FROM %s %s %s;" % \
+                                (projections, table, where_clause, ordering), args)
+
+    # sql expression of the log line (see LogTemplates)
+    def get_logs_line(self, table = 'logs'):
+        if table == 'logs' and self.logs_templates_used:
+            return LOGS_LINE
+        return 'l.line'
+
+    # after a failure, the transaction is rolled back, thus templates
+    # recorded in this transaction are lost too.
+    def rollback_logs(self):
+        self.conn.rollback()
+        self.pending_log_records = 0
+        self.logs_templates = None
 
+    # Deleting the logs of a device at once may take a long time,
+    # thus its log streams are just marked as forgotten here, and
+    # their logs are deleted progressively by the logs writer thread
+    # (see walt.server.threads.blocking.logs).
     def forget_device(self, dev_name):
         self.execute("""
-            DELETE FROM logs l USING devices d, logstreams s
-                WHERE d.name = %s AND s.sender_mac = d.mac AND l.stream_id = s.id;
-            DELETE FROM logstreams s USING devices d WHERE d.name = %s AND s.sender_mac = d.mac;
+            UPDATE logstreams s SET sender_mac = NULL, forgotten = TRUE
+                FROM devices d WHERE d.name = %s AND s.sender_mac = d.mac;
             DELETE FROM nodes n USING devices d WHERE d.name = %s AND d.mac = n.mac;
             DELETE FROM switches s USING devices d WHERE d.name = %s AND d.mac = s.mac;
             DELETE FROM topology t USING devices d WHERE d.name = %s AND d.mac = t.mac1;
             DELETE FROM topology t USING devices d WHERE d.name = %s AND d.mac = t.mac2;
             DELETE FROM devices d WHERE d.name = %s;
-        """,  (dev_name,)*7)
+        """,  (dev_name,)*6)
+        self.commit()
+
+    # Delete log records of a stream older than 'before', by chunks
+    # of at most chunk_size records.
+    # The upper bound of the chunk is found with the index on
+    # (stream_id, timestamp), and the chunk is committed at once.
+    # Return the number of records deleted, and whether all records
+    # older than 'before' are deleted.
+    def delete_logs_chunk(self, stream_id, before, chunk_size):
+        self.execute("""SELECT timestamp FROM logs
+                        WHERE stream_id = %s AND timestamp < %s
+                        ORDER BY timestamp OFFSET %s LIMIT 1;""",
+                        (stream_id, before, chunk_size))
+        row = self.c.fetchone()
+        bound = before if row is None else row.timestamp
+        deleted = self.delete_stream_logs_before(stream_id, bound, '<')
+        if deleted == 0 and row is not None:
+            # more than chunk_size records with the same timestamp
+            deleted = self.delete_stream_logs_before(stream_id, bound, '<=')
+        self.commit()
+        return deleted, row is None
+
+    # delete records and update per-minute counts accordingly
+    # (the last minute may be deleted partially).
+    def delete_stream_logs_before(self, stream_id, bound, operator):
+        self.execute("""
+            WITH deleted AS (
+                DELETE FROM logs
+                WHERE stream_id = %%(stream_id)s AND timestamp %s %%(bound)s
+                RETURNING date_trunc('minute', timestamp) AS minute),
+            minutes AS (
+                SELECT minute, count(*) AS count FROM deleted GROUP BY minute),
+            updated AS (
+                UPDATE logs_counts c SET count = c.count - m.count FROM minutes m
+                WHERE c.stream_id = %%(stream_id)s AND c.timestamp = m.minute)
+            SELECT coalesce(sum(count), 0)::bigint AS count FROM minutes;""" % operator,
+            dict(stream_id = stream_id, bound = bound))
+        deleted = self.c.fetchone().count
+        self.execute("""DELETE FROM logs_counts
+                        WHERE stream_id = %s AND count <= 0;""", (stream_id,))
+        return deleted
+
+    # Return the timestamp of the max_rows-th most recent record of
+    # this stream in the database (older records exceed the limit), or
+    # None if there are not more than max_rows records.
+    # Archived records do not count: per-minute counts of archived days
+    # are kept (see logsarchive.py), thus they are ignored here.
+    def get_logs_rows_limit(self, stream_id, max_rows):
+        self.execute("""SELECT coalesce(sum(count), 0) AS count FROM logs_counts c
+                        WHERE stream_id = %s AND NOT EXISTS (
+                            SELECT 1 FROM logs_archive a
+                            WHERE a.day = c.timestamp::date);""", (stream_id,))
+        if self.c.fetchone().count <= max_rows:
+            return None
+        self.execute("""SELECT timestamp FROM logs
+                        WHERE stream_id = %s AND timestamp IS NOT NULL
+                        ORDER BY timestamp DESC OFFSET %s LIMIT 1;""",
+                        (stream_id, max_rows - 1))
+        row = self.c.fetchone()
+        return None if row is None else row.timestamp
+
+    # Delete log records of a stream with no timestamp (legacy records
+    # kept in the default partition), by chunks of at most chunk_size
+    # records. Return True if all of them are deleted.
+    def delete_untimed_logs_chunk(self, stream_id, chunk_size):
+        self.execute("""DELETE FROM logs WHERE (tableoid, ctid) IN (
+                            SELECT tableoid, ctid FROM logs
+                            WHERE stream_id = %s AND timestamp IS NULL
+                            LIMIT %s);""", (stream_id, chunk_size))
+        deleted = self.c.rowcount
+        self.commit()
+        return deleted < chunk_size
+
+    # remove a forgotten log stream, once its logs are deleted.
+    # return False if it is still referenced (the error is printed).
+    def delete_logstream(self, stream_id):
+        try:
+            self.execute("""
+                DELETE FROM logs_counts WHERE stream_id = %s;
+                DELETE FROM logs_templates WHERE stream_id = %s;
+                DELETE FROM logstreams WHERE id = %s;""", (stream_id,)*3)
+        except IntegrityError as e:
+            self.rollback_logs()
+            print('Could not remove log stream %d: %s' % \
+                        (stream_id, str(e).splitlines()[0]))
+            return False
         self.commit()
+        return True
 
     def get_config(self, item, default = None):
         res = self.select_unique("config", item=item)
@@ -1,84 +1,543 @@
 import re, pickle
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from tempfile import TemporaryFile
+from time import time
 from walt.common.constants import WALT_SERVER_NETCONSOLE_PORT
-from walt.common.tcp import read_pickle, write_pickle, \
-                            Requests
+from walt.common.evloop import POLL_OPS_READ, POLL_OPS_WRITE
+from walt.common.io import LineReader, FrameReader
+from walt.common.tcp import read_pickle, encode_frame, \
+                            encode_log_record, encode_status_frame, Requests, \
+                            LOGS_WAIT_COMPLETED, LOGS_WAIT_TIMEOUT, \
+                            LOGS_HISTORY_COMPLETED, LOGS_DUMP_ACK, \
+                            FRAME_HEADER, MUX_LOGS_ACK, MUX_MSG_STREAM, \
+                            MUX_MAX_FRAME_SIZE, decode_mux_messages
+from walt.server import conf
+from walt.server.tools import PeriodicStats
 from walt.common.udp import udp_server_socket
 
+# settings of section "logs" of server.conf
+LOGS_CONF = (conf or {}).get('logs', {})
+
+# Log records are not inserted one by one in the database.
+# We accumulate them in memory and write them in bulk,
+# when enough records are pending or periodically.
+# Batches are written by the logs writer thread. When it has
+# LOGS_WRITER_MAX_BATCHES batches to process, producers of log
+# records are paused until it has caught up with half of them.
+LOGS_FLUSH_MAX_RECORDS  = 2000
+LOGS_FLUSH_PERIOD       = 0.5
+LOGS_WRITER_MAX_BATCHES = 8
+EV_LOGS_FLUSH           = 0
+
 class LogsToDBHandler(object):
+    def __init__(self, db, writer, hub, ev_loop):
+        self.db = db
+        self.writer = writer
+        self.hub = hub
+        self.pending = []
+        self.in_flight = 0
+        # records are given increasing ids (see db.allocate_logs_ids()),
+        # records logged up to now have an id lower or equal to last_id.
+        ids = db.allocate_logs_ids()
+        self.ids = iter(ids)
+        self.last_id = ids[0] - 1
+        ev_loop.plan_event(
+            ts = time(),
+            target = self,
+            repeat_delay = LOGS_FLUSH_PERIOD,
+            ev_type = EV_LOGS_FLUSH
+        )
+
+    def wants_stream(self, stream_info):
+        return True     # we record all logs
+
+    def log(self, stream_id, timestamp, line, **kwargs):
+        try:
+            self.last_id = next(self.ids)
+        except StopIteration:
+            self.ids = iter(self.db.allocate_logs_ids())
+            self.last_id = next(self.ids)
+        self.pending.append((stream_id, timestamp, line, self.last_id))
+        if len(self.pending) >= LOGS_FLUSH_MAX_RECORDS:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.in_flight += 1
+            self.writer.insert_logs(self.pending, self.batch_written)
+            self.pending = []
+            if self.in_flight >= LOGS_WRITER_MAX_BATCHES and not self.hub.paused:
+                self.hub.pause_producers()
+
+    def batch_written(self, result):
+        self.in_flight -= 1
+        if self.hub.paused and self.in_flight <= LOGS_WRITER_MAX_BATCHES // 2:
+            self.hub.resume_producers()
+
+    # call cb when pending records are committed (e.g. before reading
+    # them from db with another connection).
+    # we do not wait here: the db may be slow and the event loop of
+    # the main thread must remain responsive.
+    def flush_then(self, cb):
+        self.flush()
+        self.writer.wait_pending_writes(cb)
+
+    # the writer thread may be stopped already, thus we write
+    # remaining records (the batches it did not process yet, and
+    # pending ones) with our own db connection.
+    def cleanup(self):
+        for records in self.writer.pop_batches():
+            self.db.insert_logs(records)
+        if len(self.pending) > 0:
+            self.db.insert_logs(self.pending)
+            self.pending = []
+        self.db.commit()
+
+    def handle_planned_event(self, ev_type):
+        assert(ev_type == EV_LOGS_FLUSH)
+        self.flush()
+
+# A record dispatched by the hub to client handlers.
+# It is encoded at most once, on first need, and the resulting
+# bytes are shared by all the clients following this stream.
+class SharedRecord(object):
+    def __init__(self, record, stream_info):
+        self.record = record
+        self.stream_info = stream_info
+        self.encoded = None
+        self.pickled = None
+
+    def as_dict(self):
+        d = { k: v for k, v in self.record.items() if k != 'stream_id' }
+        d.update(self.stream_info)
+        return d
+
+    def get_encoded(self):
+        if self.encoded is None:
+            self.encoded = encode_log_record(self.as_dict())
+        return self.encoded
+
+    def get_pickled(self):
+        if self.pickled is None:
+            self.pickled = pickle.dumps(self.as_dict())
+        return self.pickled
+
+# Realtime clients may filter log lines with a regular expression.
+# Instead of letting each client evaluate its own expression, the hub
+# evaluates the expressions of all clients following a stream together:
+# identical expressions are evaluated once, and a combined alternation
+# of all of them is used as a prefilter, thus lines matching none of
+# them (the most common case) are rejected in a single pass.
+# When the expressions cannot be combined (e.g. back-references, or
+# different flags), we just evaluate each distinct expression.
+BACKREF = re.compile(r'\\[1-9]|\(\?P=')
+
+class MatchStats(PeriodicStats):
+    LABEL = 'log lines matching'
+
+    def reset(self):
+        self.lines = 0
+        self.rejected = 0
+        self.evaluations = 0
+        self.time_total = 0
+
+    def record_match(self, duration, evaluations, rejected):
+        self.lines += 1
+        self.evaluations += evaluations
+        self.time_total += duration
+        if rejected:
+            self.rejected += 1
+
+    def is_empty(self):
+        return self.lines == 0
+
+    def __str__(self):
+        return ('%d lines (%d rejected by prefilter), ' + \
+                '%.1f regexp evaluations per line, avg %.1fus per line') % (
+                    self.lines, self.rejected,
+                    self.evaluations / self.lines,
+                    self.time_total / self.lines * 1000000)
+
+class LoglineMatcher(object):
+    def __init__(self, handlers, stats):
+        self.stats = stats
+        # handlers which want all lines
+        self.unfiltered = []
+        # (pattern, flags) -> (regexp, handlers)
+        self.groups = {}
+        for handler in handlers:
+            regexp = getattr(handler, 'logline_regexp', None)
+            if regexp is None:
+                self.unfiltered.append(handler)
+            else:
+                key = (regexp.pattern, regexp.flags)
+                self.groups.setdefault(key, (regexp, []))[1].append(handler)
+        self.prefilter = self.compile_prefilter()
+
+    def compile_prefilter(self):
+        if len(self.groups) < 2:
+            return None     # nothing to gain
+        patterns = tuple(pattern for pattern, flags in self.groups)
+        flags = set(flags for pattern, flags in self.groups)
+        if len(flags) > 1:
+            return None
+        if any(BACKREF.search(pattern) for pattern in patterns):
+            return None     # group numbers would change
+        try:
+            return re.compile('|'.join('(?:%s)' % p for p in patterns),
+                              flags.pop())
+        except re.error:
+            return None
+
+    def get_handlers(self, line):
+        if len(self.groups) == 0:
+            return self.unfiltered
+        t0 = time()
+        handlers = list(self.unfiltered)
+        evaluations = 0
+        rejected = False
+        if self.prefilter is not None:
+            evaluations += 1
+            rejected = (self.prefilter.search(line) is None)
+        if not rejected:
+            for regexp, group in self.groups.values():
+                evaluations += 1
+                if regexp.search(line) is not None:
+                    handlers.extend(group)
+        self.stats.record_match(time() - t0, evaluations, rejected)
+        return handlers
+
+# In-memory registry of log streams and of the devices sending them,
+# loaded at startup from tables logstreams and devices.
+# Streams are registered here (and written to the db), thus
+# registering a known stream does not involve any db query.
+class LogStreamsRegistry(object):
     def __init__(self, db):
         self.db = db
+        # sender_ip -> sender_mac, sender_mac -> sender name
+        self.ip_to_mac = {}
+        self.mac_to_name = {}
+        for device in db.select('devices'):
+            self.update_device(device)
+        # (sender_mac, name) -> stream_id, stream_id -> (sender_mac, name)
+        self.stream_ids = {}
+        self.streams = {}
+        for stream in db.select('logstreams', forgotten = False):
+            self.add_stream(stream.id, stream.sender_mac, stream.name)
+        # stream_id -> sender and stream names, computed on first need
+        self.streams_info = {}
+
+    def update_device(self, device):
+        for ip, mac in list(self.ip_to_mac.items()):
+            if mac == device.mac:
+                del self.ip_to_mac[ip]
+        if device.ip is not None:
+            self.ip_to_mac[device.ip] = device.mac
+        self.mac_to_name[device.mac] = device.name
+        self.streams_info = {}
+
+    # should be called when a device was added or modified.
+    # return True if the sender names or addresses changed.
+    def device_updated(self, mac, ip):
+        if mac in self.mac_to_name and \
+                (ip is None or self.ip_to_mac.get(ip) == mac):
+            return False    # known device, same ip (renaming is
+                            # handled by reload_devices())
+        device = self.db.select_unique('devices', mac = mac)
+        if device is None:
+            return False
+        self.update_device(device)
+        return True
+
+    # should be called when sender names may have changed
+    def reload_devices(self):
+        self.ip_to_mac, self.mac_to_name = {}, {}
+        for device in self.db.select('devices'):
+            self.update_device(device)
+        self.streams_info = {}
+
+    # return the ids of the log streams of this device
+    def forget_device(self, mac):
+        self.ip_to_mac = { ip: m for ip, m in self.ip_to_mac.items() if m != mac }
+        self.mac_to_name.pop(mac, None)
+        stream_ids = []
+        for stream_id, stream in list(self.streams.items()):
+            if stream[0] == mac:
+                del self.streams[stream_id]
+                del self.stream_ids[stream]
+                stream_ids.append(stream_id)
+        self.streams_info = {}
+        return stream_ids
+
+    def add_stream(self, stream_id, sender_mac, name):
+        self.streams[stream_id] = (sender_mac, name)
+        if sender_mac is not None:
+            self.stream_ids[(sender_mac, name)] = stream_id
 
-    def log(self, **record):
-        self.db.insert('logs', **record)
+    def get_sender_mac(self, sender_ip):
+        if sender_ip not in self.ip_to_mac:
+            # unknown ip, this may be a new device
+            device = self.db.select_unique('devices', ip = sender_ip)
+            if device is None:
+                return None
+            self.update_device(device)
+        return self.ip_to_mac[sender_ip]
+
+    def get_stream_id(self, sender_ip, name):
+        sender_mac = self.get_sender_mac(sender_ip)
+        stream_id = self.stream_ids.get((sender_mac, name))
+        if stream_id is None:
+            # register new stream
+            stream_id = self.db.insert('logstreams', returning='id',
+                            sender_mac = sender_mac, name = name)
+            # records of this stream are written by the logs writer
+            # thread, with another db connection: the new stream must
+            # be visible to it.
+            self.db.commit()
+            self.add_stream(stream_id, sender_mac, name)
+        return stream_id
+
+    def get_stream_info(self, stream_id):
+        if stream_id not in self.streams_info:
+            info = None
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                sender_mac, name = stream
+                sender = self.mac_to_name.get(sender_mac)
+                if sender is not None:
+                    info = dict(sender = sender, stream = name)
+            self.streams_info[stream_id] = info
+        return self.streams_info[stream_id]
+
+# The hub keeps the most recent log records of each stream in memory,
+# in order to serve short history queries (e.g. 'walt log show
+# --history -5m: --realtime') without going through the db.
+# Memory usage is bounded: when records exceed "recent-buffer-size"
+# bytes (approximately, 32MiB by default, see section "logs" of
+# server.conf), the oldest ones are evicted, whatever their
+# stream. For each stream, we remember the most recent timestamp of
+# the evicted records: the ring has all records of the stream more
+# recent than this (assuming records are not received before their
+# timestamp, i.e. clocks of nodes are synchronized). When all records
+# of a stream are evicted, this timestamp applies to all streams
+# instead (see self.start), in order to bound memory usage.
+# Records of forgotten streams and records deleted by the retention
+# policy are removed (see forget()).
+LOGS_RECENT_MAX_SIZE = LOGS_CONF.get('recent-buffer-size', 32 * 1024 * 1024)
+LOGS_RECENT_RECORD_OVERHEAD = 160   # tuple, datetime, str header
+
+class RecentLogs(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.rings = {}     # stream_id -> deque of records
+        self.evicted = {}   # stream_id -> timestamp of last evicted record
+        self.order = deque()    # stream_id of each record, oldest first
+        # records older than this may be missing, whatever their
+        # stream (e.g. records received before we started)
+        self.start = datetime.now()
+
+    def append(self, stream_id, timestamp, line):
+        ring = self.rings.get(stream_id)
+        if ring is None:
+            ring = deque()
+            self.rings[stream_id] = ring
+        ring.append((stream_id, timestamp, line))
+        self.order.append(stream_id)
+        self.size += len(line) + LOGS_RECENT_RECORD_OVERHEAD
+        while self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        stream_id = self.order.popleft()
+        ring = self.rings.get(stream_id)
+        if ring is None:
+            return  # records of this stream were removed by forget()
+        record = ring.popleft()
+        self.size -= len(record[2]) + LOGS_RECENT_RECORD_OVERHEAD
+        evicted = max(record[1], self.evicted.get(stream_id, record[1]))
+        if len(ring) == 0:
+            del self.rings[stream_id]
+            self.evicted.pop(stream_id, None)
+            self.start = max(self.start, evicted)
+        else:
+            self.evicted[stream_id] = evicted
+
+    # remove the records of a stream older than 'before', or all of
+    # them if before is None (the stream is forgotten).
+    def forget(self, stream_id, before = None):
+        ring = self.rings.pop(stream_id, None)
+        if before is None:
+            self.evicted.pop(stream_id, None)
+        if ring is None:
+            return
+        kept = deque()
+        for record in ring:
+            if before is not None and record[1] >= before:
+                kept.append(record)
+            else:
+                self.size -= len(record[2]) + LOGS_RECENT_RECORD_OVERHEAD
+        if len(kept) > 0:
+            self.rings[stream_id] = kept
+
+    # return the records of the given streams in the history range,
+    # ordered by timestamp, or None if some of them may be missing.
+    # the rings are copied at once, but records are filtered and
+    # merged lazily, by the consumer of the returned iterator.
+    def get(self, history, stream_ids):
+        start, end = history
+        if start is None or start < self.start:
+            return None
+        for stream_id in stream_ids:
+            evicted = self.evicted.get(stream_id)
+            if evicted is not None and start < evicted:
+                return None
+        rings = [ sorted(self.rings[stream_id], key = itemgetter(1)) \
+                  for stream_id in stream_ids if stream_id in self.rings ]
+        return (record for record in merge(*rings, key = itemgetter(1)) \
+                if record[1] > start and (end is None or record[1] < end))
 
 class LogsHub(object):
-    def __init__(self):
+    def __init__(self, registry):
+        self.registry = registry
+        self.recent = RecentLogs(LOGS_RECENT_MAX_SIZE)
         self.handlers = set([])
+        # stream_id -> matcher of handlers interested in this stream.
+        # this index is computed lazily for each stream_id
+        # and discarded when handlers are added or removed.
+        self.dispatch = {}
+        self.match_stats = MatchStats()
+        self.ev_loop = None
+        # backpressure (see LogsToDBHandler)
+        self.paused = False
+        self.muted = {}     # fd -> producer
+
+    def join_event_loop(self, ev_loop):
+        self.ev_loop = ev_loop
+        self.match_stats.join_event_loop(ev_loop)
+
+    def pause_producers(self):
+        self.paused = True
+
+    def resume_producers(self):
+        self.paused = False
+        for fd, producer in self.muted.items():
+            # the producer may have been closed meanwhile
+            if self.ev_loop.listeners.get(fd) is producer:
+                self.ev_loop.update_listener(producer, POLL_OPS_READ)
+        self.muted = {}
+
+    # producers (listeners of log streams) call this when they get
+    # an event: if we are paused, they are muted, and will get
+    # events again when we resume.
+    def mute_if_paused(self, producer):
+        if not self.paused:
+            return False
+        self.ev_loop.update_listener(producer, 0)
+        self.muted[producer.fileno()] = producer
+        return True
 
     def addHandler(self, handler):
         self.handlers.add(handler)
+        self.dispatch = {}
 
     def removeHandler(self, handler):
-        self.handlers.remove(handler)
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+            self.dispatch = {}
+
+    # should be called when sender names may have changed
+    def reset_streams_info(self):
+        self.dispatch = {}
+
+    def get_stream_info(self, stream_id):
+        return self.registry.get_stream_info(stream_id)
+
+    def get_matcher(self, stream_id):
+        matcher = self.dispatch.get(stream_id)
+        if matcher is None:
+            stream_info = self.get_stream_info(stream_id)
+            handlers = tuple(handler for handler in self.handlers \
+                                if handler.wants_stream(stream_info))
+            matcher = LoglineMatcher(handlers, self.match_stats)
+            self.dispatch[stream_id] = matcher
+        return matcher
 
     def log(self, **kwargs):
+        if kwargs['stream_id'] not in self.registry.streams:
+            # the device was forgotten, but a connection opened
+            # earlier still sends records of this stream: these
+            # would violate the foreign key of the logs table.
+            return
+        self.recent.append(kwargs['stream_id'], kwargs['timestamp'], kwargs['line'])
         to_be_removed = set([])
-        for handler in self.handlers:
-            res = handler.log(**kwargs)
+        shared = None
+        matcher = self.get_matcher(kwargs['stream_id'])
+        for handler in matcher.get_handlers(kwargs['line']):
+            if shared is None:
+                stream_info = self.get_stream_info(kwargs['stream_id'])
+                shared = SharedRecord(kwargs, stream_info)
+            res = handler.log(shared = shared, **kwargs)
             # a handler may request to be deleted
             # by returning False
             if res == False:
                 to_be_removed.add(handler)
         for handler in to_be_removed:
-            self.handlers.remove(handler)
+            self.removeHandler(handler)
 
 class LogsStreamListener(object):
-    def __init__(self, db, hub, sock_file, **kwargs):
-        self.db = db
+    def __init__(self, registry, hub, sock_file, **kwargs):
+        self.registry = registry
         self.hub = hub
         self.sock_file = sock_file
+        self.reader = LineReader(sock_file)
+        self.header = []
         self.stream_id = None
         self.server_timestamps = None
 
     def register_stream(self):
-        name = self.sock_file.readline().strip().decode('UTF-8')
-        timestamps_mode = self.sock_file.readline().strip()
+        name = self.header[0].strip().decode('UTF-8')
+        timestamps_mode = self.header[1].strip()
         self.server_timestamps = (timestamps_mode == b'NO_TIMESTAMPS')
         sender_ip, sender_port = self.sock_file.getpeername()
-        sender_info = self.db.select_unique('devices', ip = sender_ip)
-        if sender_info == None:
-            sender_mac = None
-        else:
-            sender_mac = sender_info.mac
-        stream_info = self.db.select_unique('logstreams',
-                            sender_mac = sender_mac, name = name)
-        if stream_info:
-            # found existing stream
-            stream_id = stream_info.id
-        else:
-            # register new stream
-            stream_id = self.db.insert('logstreams', returning='id',
-                            sender_mac = sender_mac, name = name)
+        stream_id = self.registry.get_stream_id(sender_ip, name)
         # these are not needed anymore
-        self.db = None
+        self.registry = None
+        self.header = None
         return stream_id
 
     # let the event loop know what we are reading on
     def fileno(self):
         return self.sock_file.fileno()
     # when the event loop detects an event for us, we
-    # know a log line should be read.
+    # know log lines should be read.
+    # we process all complete lines available (up to the
+    # limit of the reader) instead of just one.
     def handle_event(self, ts):
-        if self.stream_id == None:
-            self.stream_id = self.register_stream()
-            # register_stream() involves a read on the stream
-            # to get its name.
-            # supposedly that's why we have been woken up.
-            # let the event loop call us again if there is more.
+        if self.hub.mute_if_paused(self):
             return True
+        for inputline in self.reader.read_lines():
+            if self.stream_id == None:
+                # the 2 first lines give the name of the stream
+                # and the timestamps mode.
+                self.header.append(inputline)
+                if len(self.header) == 2:
+                    self.stream_id = self.register_stream()
+                continue
+            if self.handle_line(inputline, ts) == False:
+                return False
+        if self.reader.eof:
+            if self.stream_id is not None:
+                print('Log stream with id %d is being closed.' % self.stream_id)
+            return False
+        return True
+    def handle_line(self, inputline, ts):
         try:
-            inputline = self.sock_file.readline().strip().decode('UTF-8')
+            inputline = inputline.strip().decode('UTF-8')
             if inputline == 'CLOSE':
                 return False    # stop here
             if self.server_timestamps:
@@ -102,18 +561,101 @@ class LogsStreamListener(object):
             record['timestamp'] = datetime.fromtimestamp(ts)
         record.update(stream_id=self.stream_id)
         self.hub.log(**record)
+    def close(self):
+        self.sock_file.close()
+
+# Listener for REQ_MUX_INCOMING_LOGS connections, which carry
+# all log streams of a node (see walt.common.tcp).
+class LogsMuxListener(object):
+    def __init__(self, registry, hub, sock_file, **kwargs):
+        self.registry = registry
+        self.hub = hub
+        self.sock_file = sock_file
+        self.sender_ip, sender_port = sock_file.getpeername()
+        # stream_num (chosen by the node) -> stream_id
+        self.stream_ids = {}
+        self.sock_file.write(MUX_LOGS_ACK)
+        self.sock_file.flush()
+        self.reader = FrameReader(sock_file, FRAME_HEADER,
+                                  max_frame_size = MUX_MAX_FRAME_SIZE)
+
+    # let the event loop know what we are reading on
+    def fileno(self):
+        return self.sock_file.fileno()
+
+    def handle_event(self, ts):
+        if self.hub.mute_if_paused(self):
+            return True
+        try:
+            for frame in self.reader.read_frames():
+                for msg in decode_mux_messages(frame):
+                    if msg[0] == MUX_MSG_STREAM:
+                        stream_num, name = msg[1:]
+                        self.stream_ids[stream_num] = \
+                                self.registry.get_stream_id(self.sender_ip, name)
+                    else:
+                        stream_num, timestamp, line = msg[1:]
+                        self.hub.log(stream_id = self.stream_ids[stream_num],
+                                     timestamp = datetime.fromtimestamp(timestamp),
+                                     line = line)
+        except Exception as e:
+            print(e)
+            print('Multiplexed log connection of %s is being closed.' % self.sender_ip)
+            return False
+        if self.reader.eof:
+            return False
         return True
+
     def close(self):
         self.sock_file.close()
 
+# Netconsole messages may use the extended format (option "+" of
+# netconsole, see Documentation/networking/netconsole.rst):
+# <level>,<seq>,<kernel_ts_usec>,<flags>[,ncfrag=<offset>/<total>];<text>
+# Messages longer than a datagram are sent as several fragments
+# (ncfrag), and with older kernels, a message may be continued by
+# next ones (flags 'c' then '+').
+NETCONSOLE_EXT_HEADER = re.compile(
+        rb'^(\d+),(\d+),(\d+),([^,;]*)(?:,ncfrag=(\d+)/(\d+))?[^;]*;')
+# max number of datagrams processed per event loop wakeup
+NETCONSOLE_BUDGET = 1000
+# a message continued by next ones is logged when the next message
+# of this sender which is not a continuation arrives, or after
+# NETCONSOLE_CONT_DELAY seconds (the kernel may never send one).
+NETCONSOLE_CONT_DELAY = 1.0
+
+class NetconsoleSender(object):
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        # pending message, when a line is received in multiple
+        # parts before getting the end-of-line char
+        self.partial = b''
+        # extended format
+        self.last_seq = None
+        self.boot_time = None
+        self.fragments = {}
+        self.cont = None
+        self.cont_ts = None
+        self.lost = 0
+
+    # kernel timestamps are relative to boot time, which we estimate
+    # (network delays can only make this estimate too late).
+    def get_timestamp(self, kernel_ts, ts):
+        boot_time = ts - kernel_ts / 1000000
+        if self.boot_time is None or boot_time < self.boot_time:
+            self.boot_time = boot_time
+        return self.boot_time + kernel_ts / 1000000
+
 class NetconsoleListener(object):
     """Listens for netconsole messages sent by nodes over UDP, and store
     them as regular logs."""
-    def __init__(self, db, hub, port, **kwargs):
-        self.db = db
+    def __init__(self, registry, hub, port, **kwargs):
+        self.registry = registry
         self.hub = hub
         self.s = udp_server_socket(port)
+        self.s.setblocking(False)
         self.sender_info = dict()
+        self.cont_flush_planned = False
 
     def join_event_loop(self, ev_loop):
         self.ev_loop = ev_loop
@@ -123,48 +665,109 @@ class NetconsoleListener(object):
     def fileno(self):
         return self.s.fileno()
 
-    def handle_event(self, ts):
-        # TODO: we should decode the extended format and handle continuation messages.
-        # https://www.kernel.org/doc/Documentation/ABI/testing/dev-kmsg
-        (msg, addrinfo) = self.s.recvfrom(9000)
-        sender_ip, sender_port = addrinfo
+    def get_sender(self, sender_ip):
         if sender_ip not in self.sender_info:
-            # Cache IP -> stream ID association, to avoid hitting the
-            # database for each received netconsole message.
-            sender_info = self.db.select_unique('devices', ip=sender_ip)
-            if sender_info == None:
-                sender_mac = None
-                stream_info = None
-            else:
-                sender_mac = sender_info.mac
-                stream_info = self.db.select_unique('logstreams', sender_mac=sender_mac,
-                                                    name='netconsole')
-            if stream_info:
-                # found existing stream
-                stream_id = stream_info.id
+            # Keep per-sender state, with the stream ID
+            stream_id = self.registry.get_stream_id(sender_ip, 'netconsole')
+            self.sender_info[sender_ip] = NetconsoleSender(stream_id)
+        return self.sender_info[sender_ip]
+
+    def handle_event(self, ts):
+        if self.hub.mute_if_paused(self):
+            return True
+        # process all pending datagrams (up to NETCONSOLE_BUDGET)
+        for i in range(NETCONSOLE_BUDGET):
+            try:
+                (msg, addrinfo) = self.s.recvfrom(9000)
+            except BlockingIOError:
+                break
+            sender_ip, sender_port = addrinfo
+            sender = self.get_sender(sender_ip)
+            match = NETCONSOLE_EXT_HEADER.match(msg)
+            if match is None:
+                self.handle_msg(sender, msg, ts)
             else:
-                # register new stream
-                stream_id = self.db.insert('logstreams', returning='id',
-                                           sender_mac=sender_mac, name='netconsole')
-            # Second list element is the current pending message for this sender
-            # (in some cases we may receive a line in multiple parts before getting
-            # the end-of-line char)
-            self.sender_info[sender_ip] = [stream_id, b'']
-        stream_id, cur_msg = self.sender_info[sender_ip]
-        cur_msg += msg
+                self.handle_ext_msg(sender, match, msg[match.end():], ts)
+        return True
+
+    def log(self, sender, timestamp, line):
+        if not isinstance(timestamp, datetime):
+            timestamp = datetime.fromtimestamp(timestamp)
+        self.hub.log(timestamp = timestamp,
+                     line = line.decode('UTF-8', 'replace'),
+                     stream_id = sender.stream_id)
+
+    def handle_msg(self, sender, msg, ts):
+        cur_msg = sender.partial + msg
         # log terminated lines
         lines = cur_msg.split(b'\n')
-        if len(lines) > 1:
-            timestamp = ts
-            if not isinstance(timestamp, datetime):
-                timestamp = datetime.fromtimestamp(timestamp)
-            for line in lines[:-1]: # terminated lines
-                record = dict(timestamp=timestamp, line=line.decode('ascii'), stream_id=stream_id)
-                self.hub.log(**record)
+        for line in lines[:-1]: # terminated lines
+            self.log(sender, ts, line)
         # update current message of this sender
-        cur_msg = lines[-1] # last line (unterminated one)
-        self.sender_info[sender_ip][1] = cur_msg
-        return True
+        sender.partial = lines[-1] # last line (unterminated one)
+
+    def handle_ext_msg(self, sender, match, text, ts):
+        level, seq, kernel_ts, flags, frag_offset, frag_total = match.groups()
+        seq, kernel_ts = int(seq), int(kernel_ts)
+        if frag_total is not None:
+            # fragments of a message share the same header
+            if sender.last_seq != seq:
+                sender.fragments = {}
+            sender.fragments[int(frag_offset)] = text
+            self.check_seq(sender, seq, ts)
+            if sum(len(f) for f in sender.fragments.values()) < int(frag_total):
+                return  # wait for other fragments
+            text = b''.join(f for offset, f in sorted(sender.fragments.items()))
+            sender.fragments = {}
+        else:
+            self.check_seq(sender, seq, ts)
+        # drop the dictionary (key=value lines) which may follow the text
+        text = text.split(b'\n', 1)[0]
+        timestamp = sender.get_timestamp(kernel_ts, ts)
+        if flags == b'+' and sender.cont is not None:
+            sender.cont[1] += text
+            return
+        if sender.cont is not None:
+            self.log(sender, *sender.cont)
+            sender.cont = None
+        if flags == b'c':
+            sender.cont = [timestamp, text]
+            sender.cont_ts = ts
+            self.plan_cont_flush(ts + NETCONSOLE_CONT_DELAY)
+        else:
+            self.log(sender, timestamp, text)
+
+    def plan_cont_flush(self, ts):
+        if not self.cont_flush_planned:
+            self.cont_flush_planned = True
+            self.ev_loop.plan_event(ts = ts, target = self)
+
+    def handle_planned_event(self):
+        self.cont_flush_planned = False
+        limit = time() - NETCONSOLE_CONT_DELAY
+        next_ts = None
+        for sender in self.sender_info.values():
+            if sender.cont is None:
+                continue
+            if sender.cont_ts <= limit:
+                self.log(sender, *sender.cont)
+                sender.cont = None
+            elif next_ts is None or sender.cont_ts < next_ts:
+                next_ts = sender.cont_ts
+        if next_ts is not None:
+            self.plan_cont_flush(next_ts + NETCONSOLE_CONT_DELAY)
+
+    def check_seq(self, sender, seq, ts):
+        if sender.last_seq is not None:
+            if seq < sender.last_seq:
+                # node rebooted
+                sender.boot_time = None
+            elif seq > sender.last_seq + 1:
+                lost = seq - sender.last_seq - 1
+                sender.lost += lost
+                self.log(sender, ts,
+                    b'[netconsole: %d kernel messages lost]' % lost)
+        sender.last_seq = seq
 
     def forget_ip(self, device_ip):
         if device_ip in self.sender_info:
@@ -173,94 +776,420 @@ class NetconsoleListener(object):
     def close(self):
         self.s.close()
 
-PHASE_WAIT_FOR_BLCK_THREAD = 0
+# Buffer of realtime records, used while history is being dumped.
+# Records are kept in memory up to max_records, then spilled to a
+# temporary file, in order to bound memory usage when a long
+# history dump occurs during a log storm.
+# Once closed (the client disconnected), records are ignored.
+REALTIME_BUFFER_MAX_RECORDS = 10000
+
+class SpillableBuffer(object):
+    def __init__(self, max_records):
+        self.max_records = max_records
+        self.records = []
+        self.spill_file = None
+        self.num_spilled = 0
+        self.closed = False
+
+    def append(self, record):
+        if self.closed:
+            return
+        if self.spill_file is None:
+            if len(self.records) < self.max_records:
+                self.records.append(record)
+                return
+            self.spill_file = TemporaryFile()
+        pickle.dump(record, self.spill_file, pickle.HIGHEST_PROTOCOL)
+        self.num_spilled += 1
+
+    def __len__(self):
+        return len(self.records) + self.num_spilled
+
+    def __iter__(self):
+        yield from self.records
+        if self.spill_file is not None:
+            self.spill_file.seek(0)
+            for i in range(self.num_spilled):
+                yield pickle.load(self.spill_file)
+
+    def close(self):
+        self.closed = True
+        self.records = []
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            self.num_spilled = 0
+
 PHASE_RETRIEVING_FROM_DB = 1
 PHASE_SENDING_TO_CLIENT = 2
+
+# If the client requests batched mode, records are grouped in frames.
+# A frame is sent when it reaches BATCH_MAX_SIZE bytes, or at most
+# BATCH_MAX_DELAY seconds after its first record was queued.
+BATCH_MAX_SIZE  = 64 * 1024
+BATCH_MAX_DELAY = 0.1
+EV_BATCH_FLUSH  = 0
+
+# Recent history served from memory (see RecentLogs) is written by
+# chunks of RECENT_HISTORY_CHUNK_SIZE records, one chunk per event
+# of the main loop. Like a history dump of the blocking thread, it
+# is paused while the queue of the client is full.
+RECENT_HISTORY_CHUNK_SIZE = 1000
+RECENT_HISTORY = -1     # (value of paused_history)
+EV_RECENT_HISTORY = 2
+
+# "walt log wait" requests are evaluated here: we only send the
+# matching lines which complete the wait condition (the first one in
+# mode ANY, the first one of each sender in mode ALL), followed by a
+# status (LOGS_WAIT_COMPLETED or LOGS_WAIT_TIMEOUT).
+EV_WAIT_TIMEOUT = 1
+
+# Data sent to a client is queued and written only when its socket
+# is writable, thus a slow client cannot block the event loop.
+# The queue is bounded; if a realtime client cannot keep up, we apply
+# the overflow policy given in section "logs" of server.conf:
+# - "drop-oldest" (default): drop the oldest queued realtime records,
+#   and let the client know how many lines were skipped.
+# - "disconnect": close the connection of the client.
+# History records are never dropped: when the queue is full after a
+# history chunk, the dump is paused (see pause_history()), and resumed
+# by handle_write_event() once the client has consumed enough data
+# (see resume_history()). The blocking thread does not wait meanwhile.
+CLIENT_QUEUE_MAX_SIZE = LOGS_CONF.get('client-queue-size', 4 * 1024 * 1024)
+CLIENT_OVERFLOW_POLICY = LOGS_CONF.get('client-overflow-policy', 'drop-oldest')
+
 class LogsToSocketHandler(object):
-    def __init__(self, db, hub, sock_file, blocking, **kwargs):
+    def __init__(self, db, db_handler, hub, sock_file, blocking, ev_loop,
+                 ack = False, **kwargs):
+        if ack:
+            sock_file.write(LOGS_DUMP_ACK)
+            sock_file.flush()
         self.db = db
+        self.db_handler = db_handler
         self.sock_file = sock_file
-        self.cache = {}
         self.params = None
         self.hub = hub
         self.blocking = blocking
+        self.ev_loop = ev_loop
         self.phase = None
-        self.realtime_buffer = []
-        #sock.settimeout(1.0)
-    def log(self, **record):
-        if self.phase == PHASE_WAIT_FOR_BLCK_THREAD:
-            # blocking thread is not ready yet,
-            # we will let the log go to db and
-            # the blocking thread will retrieve it later.
-            return
-        elif self.phase == PHASE_RETRIEVING_FROM_DB:
+        self.realtime_buffer = None
+        self.batched = False
+        self.batch = []
+        self.batch_size = 0
+        self.batch_flush_planned = False
+        # queue of [data, num_records, droppable] items waiting
+        # to be sent (data is None for a "lines skipped" marker)
+        self.out_queue = deque()
+        self.out_size = 0
+        self.out_offset = 0
+        self.want_write = False
+        self.close_when_sent = False
+        self.wait = None
+        self.wait_completed = False
+        self.wait_missing_senders = None
+        self.history_status = False
+        # see pause_history()
+        self.paused_history = None
+        self.recent_history = None
+        # see handle_params()
+        self.resume_timestamp = None
+        self.resume_skip = 0
+    def log(self, shared = None, **record):
+        if self.sock_file.closed:
+            # the client disconnected, possibly while history
+            # was being retrieved: let the hub remove us.
+            return False
+        if self.phase == PHASE_RETRIEVING_FROM_DB:
             # the blocking thread is still sending logs
             # from db
             # => do not send the realtime logs right now,
             # record them for later
             self.realtime_buffer.append(record)
         elif self.phase == PHASE_SENDING_TO_CLIENT:
-            return self.write_to_client(**record)
-    def notify_history_processing_startup(self):
+            return self.write_to_client(filtered=True,
+                                        shared=shared, **record)
+    # realtime records received from now on are buffered while
+    # history is being sent. Return the id of the last record
+    # received before, which bounds the history.
+    def start_realtime_buffering(self):
+        self.realtime_buffer = SpillableBuffer(REALTIME_BUFFER_MAX_RECORDS)
         self.phase = PHASE_RETRIEVING_FROM_DB
+        return self.db_handler.last_id
+
+    def start_db_logs_streaming(self, result):
+        if self.sock_file.closed:
+            return  # client already disconnected
+        self.blocking.stream_db_logs(self)
     def notify_history_processed(self):
+        if self.history_status and not self.sock_file.closed:
+            try:
+                self.flush_batch()
+                self.send(encode_status_frame(LOGS_HISTORY_COMPLETED), 0,
+                          droppable = False)
+            except IOError:
+                pass
         if self.params['realtime']:
             # done with the history part.
-            # we can flush the buffer of realtime logs
+            # we can flush the buffer of realtime logs.
+            # (history was limited to the records received before we
+            # started buffering, see start_realtime_buffering())
             for record in self.realtime_buffer:
-                if self.write_to_client(**record) == False:
+                if self.write_to_client(filtered=True, **record) == False:
                     break
+            self.realtime_buffer.close()
+            self.realtime_buffer = None
+            # records batched up to now are not droppable
+            try:
+                self.flush_batch()
+            except IOError:
+                pass
             # notify that next logs can be sent
             # directly to the client
             self.phase = PHASE_SENDING_TO_CLIENT
         else:
             # no realtime mode, we can quit
-            self.close()
-    def write_to_client(self, stream_id, senders_filtered=False, **record):
+            try:
+                self.flush_batch()
+            except IOError:
+                pass
+            self.close_after_sending()
+    # history records are received from the blocking thread by chunks
+    # of (stream_id, timestamp, line) tuples.
+    def write_history_chunk(self, records):
+        if self.sock_file.closed:
+            return False
+        for stream_id, timestamp, line in records:
+            if self.write_to_client(stream_id = stream_id,
+                                    timestamp = timestamp,
+                                    line = line) == False:
+                return False
+    def is_queue_full(self):
+        return not self.sock_file.closed and \
+               self.out_size >= CLIENT_QUEUE_MAX_SIZE
+    # called by the blocking thread after each history chunk.
+    # if the queue is full, we return True: the blocking thread
+    # pauses this history dump, and we resume it when the client
+    # has consumed its data (or is disconnected).
+    def pause_history(self, history_id):
+        if self.is_queue_full():
+            self.paused_history = history_id
+            return True
+        return False
+    def resume_history(self):
+        history_id, self.paused_history = self.paused_history, None
+        if history_id == RECENT_HISTORY:
+            self.plan_recent_history_chunk()
+        else:
+            self.blocking.resume_db_logs(history_id)
+    def plan_recent_history_chunk(self):
+        self.ev_loop.plan_event(
+            ts = time(),
+            target = self,
+            ev_type = EV_RECENT_HISTORY
+        )
+    def write_recent_history_chunk(self):
+        records = tuple(islice(self.recent_history, RECENT_HISTORY_CHUNK_SIZE))
+        if len(records) == RECENT_HISTORY_CHUNK_SIZE and \
+                self.write_history_chunk(records) != False:
+            if not self.pause_history(RECENT_HISTORY):
+                self.plan_recent_history_chunk()
+            return
+        if 0 < len(records) < RECENT_HISTORY_CHUNK_SIZE:
+            self.write_history_chunk(records)
+        self.recent_history = None
+        self.notify_history_processed()
+    def wants_stream(self, stream_info):
+        if stream_info is None:
+            return False    # unknown sender
+        if stream_info['sender'] not in self.senders:
+            return False
+        if self.streams_regexp:
+            matches = self.streams_regexp.findall(stream_info['stream'])
+            if len(matches) == 0:
+                return False
+        return True
+    def write_to_client(self, stream_id, filtered=False, shared=None, **record):
+        if self.wait_completed:
+            return False
         try:
-            if stream_id not in self.cache:
-                self.cache[stream_id] = self.db.execute(
-                """SELECT d.name as sender, s.name as stream
-                   FROM logstreams s, devices d
-                   WHERE s.id = %s
-                     AND s.sender_mac = d.mac
-                """ % stream_id).fetchall()[0]._asdict()
-            stream_info = self.cache[stream_id]
-            # when data comes from the db, senders are already filtered,
-            # while data coming from the hub has to be filtered.
-            if not senders_filtered:
-                if stream_info['sender'] not in self.params['senders']:
+            stream_info = self.hub.get_stream_info(stream_id)
+            # data coming from the hub is already filtered according to its
+            # stream and line (cf. LogsHub.get_matcher()), while data coming
+            # from the db has to be filtered here.
+            if not filtered:
+                if not self.wants_stream(stream_info):
                     return  # filter out
-            # matching the streams or the logline is always done here, otherwise
-            # there may be inconsistencies between the regexp format in the
-            # postgresql database and in python
-            if self.streams_regexp:
-                matches = self.streams_regexp.findall(stream_info['stream'])
-                if len(matches) == 0:
-                    return  # filter out
-            if self.logline_regexp:
-                matches = self.logline_regexp.findall(record['line'])
-                if len(matches) == 0:
-                    return  # filter out
-            d = {}
-            d.update(record)
-            d.update(stream_info)
+                if self.logline_regexp:
+                    if self.logline_regexp.search(record['line']) is None:
+                        return  # filter out
+                if self.resume_skip > 0 and \
+                        record['timestamp'] == self.resume_timestamp:
+                    self.resume_skip -= 1
+                    return  # already received by the client
+            if self.wait is not None:
+                if self.wait['mode'] == 'ALL':
+                    sender = stream_info['sender']
+                    if sender not in self.wait_missing_senders:
+                        return  # this sender already matched
+                    self.wait_missing_senders.discard(sender)
+                    completed = len(self.wait_missing_senders) == 0
+                else:
+                    completed = True
+            if shared is None:
+                shared = SharedRecord(record, stream_info)
             if self.sock_file.closed:
                 raise IOError()
-            write_pickle(d, self.sock_file)
+            if self.batched:
+                self.queue_record(shared.get_encoded())
+            else:
+                self.send(shared.get_pickled(), 1)
+            if self.wait is not None and completed:
+                self.complete_wait(LOGS_WAIT_COMPLETED)
+                return False
         except IOError as e:
             # the socket was supposedly closed.
             print("client log connection closing")
+            self.disconnect()
             # notify the hub that we should be removed.
             return False
+    def disconnect(self):
+        if not self.sock_file.closed:
+            self.ev_loop.remove_listener(self)
+    def queue_record(self, encoded):
+        self.batch.append(encoded)
+        self.batch_size += len(encoded)
+        if self.batch_size >= BATCH_MAX_SIZE:
+            self.flush_batch()
+        elif not self.batch_flush_planned:
+            # ensure this record will not wait too long
+            self.ev_loop.plan_event(
+                ts = time() + BATCH_MAX_DELAY,
+                target = self,
+                ev_type = EV_BATCH_FLUSH
+            )
+            self.batch_flush_planned = True
+    def flush_batch(self):
+        if len(self.batch) > 0:
+            payload = b''.join(self.batch)
+            num_records = len(self.batch)
+            self.batch, self.batch_size = [], 0
+            self.send(encode_frame(payload), num_records)
+    def send(self, data, num_records, droppable = None):
+        # realtime records may be dropped, history records may not
+        if droppable is None:
+            droppable = (self.phase == PHASE_SENDING_TO_CLIENT)
+        self.out_queue.append([data, num_records, droppable])
+        self.out_size += len(data)
+        self.write_pending()
+        if self.out_size > CLIENT_QUEUE_MAX_SIZE and droppable:
+            self.handle_overflow()
+    def handle_overflow(self):
+        if CLIENT_OVERFLOW_POLICY == 'disconnect':
+            print("client log connection too slow, disconnecting")
+            raise IOError()
+        # drop-oldest policy.
+        # the first item may be partially sent already, do not drop it.
+        idx = 1 if self.out_offset > 0 else 0
+        # reuse or insert the "lines skipped" marker
+        if idx < len(self.out_queue) and self.out_queue[idx][0] is None:
+            marker = self.out_queue[idx]
+        else:
+            marker = [None, 0, False]
+            self.out_queue.insert(idx, marker)
+        idx += 1
+        while self.out_size > CLIENT_QUEUE_MAX_SIZE and \
+                idx < len(self.out_queue):
+            data, num_records, droppable = self.out_queue[idx]
+            if not droppable:
+                idx += 1
+                continue
+            del self.out_queue[idx]
+            self.out_size -= len(data)
+            marker[1] += num_records
+    def encode_skipped_marker(self, num_skipped):
+        d = dict(timestamp = datetime.now(),
+                 sender = 'walt-server',
+                 stream = 'logs',
+                 line = '[%d lines skipped: client too slow]' % num_skipped)
+        if self.batched:
+            return encode_frame(encode_log_record(d))
+        else:
+            return pickle.dumps(d)
+    def write_pending(self):
+        if self.sock_file.closed:
+            raise IOError()
+        sock = self.sock_file.sock
+        while len(self.out_queue) > 0:
+            item = self.out_queue[0]
+            if item[0] is None:
+                item[0] = self.encode_skipped_marker(item[1])
+                self.out_size += len(item[0])
+            data = item[0]
+            try:
+                sent = sock.send(memoryview(data)[self.out_offset:])
+            except BlockingIOError:
+                break
+            self.out_offset += sent
+            if self.out_offset < len(data):
+                break
+            self.out_queue.popleft()
+            self.out_size -= len(data)
+            self.out_offset = 0
+        # let the event loop wake us up when we can write more
+        want_write = len(self.out_queue) > 0
+        if want_write != self.want_write:
+            events = POLL_OPS_READ | POLL_OPS_WRITE if want_write else POLL_OPS_READ
+            self.ev_loop.update_listener(self, events)
+            self.want_write = want_write
+    def is_done(self):
+        return self.close_when_sent and len(self.out_queue) == 0
+    def close_after_sending(self):
+        self.close_when_sent = True
+        if self.is_done() and not self.sock_file.closed:
+            self.ev_loop.remove_listener(self)
+    def complete_wait(self, status):
+        self.wait_completed = True
+        self.flush_batch()
+        self.send(encode_status_frame(status), 0, droppable = False)
+        self.close_after_sending()
+    def handle_planned_event(self, ev_type):
+        if ev_type == EV_BATCH_FLUSH:
+            self.batch_flush_planned = False
+        if self.sock_file.closed:
+            return
+        try:
+            if ev_type == EV_BATCH_FLUSH:
+                self.flush_batch()
+            elif ev_type == EV_WAIT_TIMEOUT and not self.wait_completed:
+                self.complete_wait(LOGS_WAIT_TIMEOUT)
+            elif ev_type == EV_RECENT_HISTORY:
+                self.write_recent_history_chunk()
+        except IOError:
+            self.disconnect()   # the hub will remove us when next record comes
     # let the event loop know what we are reading on
     def fileno(self):
         return self.sock_file.fileno()
-    # this is what we will do depending on the client request params
-    def handle_params(self, history, realtime, senders, streams, logline_regexp):
+    # this is what we will do depending on the client request params.
+    # a client may resume a previous dump by specifying resume=(timestamp,
+    # count), where timestamp is the timestamp of the last record it
+    # received, and count the number of records it received with this
+    # timestamp (history records are ordered by timestamp, stream and
+    # insertion order, thus they are skipped).
+    # if history_status is True, LOGS_HISTORY_COMPLETED is sent after
+    # the history records.
+    def handle_params(self, history, realtime, senders, streams, logline_regexp,
+                            batched = False, wait = None, resume = None,
+                            history_status = False, **kwargs):
         if history:
             # unpickle the elements of the history range
             history = tuple(pickle.loads(e) if e else None for e in history)
+        if resume:
+            timestamp, count = resume
+            self.resume_timestamp = pickle.loads(timestamp)
+            self.resume_skip = count
+            end = history[1] if history else None
+            # (timestamps have a precision of one microsecond)
+            history = (self.resume_timestamp - timedelta(microseconds = 1), end)
         if streams:
             self.streams_regexp = re.compile(streams)
         else:
@@ -269,12 +1198,40 @@ class LogsToSocketHandler(object):
             self.logline_regexp = re.compile(logline_regexp)
         else:
             self.logline_regexp = None
+        self.senders = set(senders)
+        self.batched = batched
+        self.history_status = history_status
+        if wait is not None:
+            self.wait = wait
+            self.wait_missing_senders = set(senders)
+            if wait.get('timeout'):
+                self.ev_loop.plan_event(
+                    ts = time() + wait['timeout'],
+                    target = self,
+                    ev_type = EV_WAIT_TIMEOUT
+                )
         self.params = dict( history = history,
                             realtime = realtime,
                             senders = senders)
         if history:
-            self.phase = PHASE_WAIT_FOR_BLCK_THREAD
-            self.blocking.stream_db_logs(self)
+            stream_ids = self.db.get_matching_logstream_ids(senders, streams)
+            records = self.hub.recent.get(history, stream_ids)
+            if records is not None:
+                # recent history, served from memory
+                self.start_realtime_buffering()
+                self.recent_history = records
+                self.plan_recent_history_chunk()
+            else:
+                # let the db filter out history records as much as possible
+                self.params.update(
+                    stream_ids = stream_ids,
+                    logline_regexp = logline_regexp,
+                    max_id = self.start_realtime_buffering())
+                # realtime logs received up to now were not sent to
+                # the client, because they are expected to be retrieved
+                # from db: let the blocking thread start when they are
+                # really there.
+                self.db_handler.flush_then(self.start_db_logs_streaming)
         else:
             self.phase = PHASE_SENDING_TO_CLIENT
         if realtime:
@@ -283,35 +1240,146 @@ class LogsToSocketHandler(object):
     def handle_event(self, ts):
         if self.params == None:
             params = read_pickle(self.sock_file)
+            # from now on, we should never block on this socket
+            self.sock_file.sock.setblocking(False)
             self.handle_params(**params)
         else:
             return False    # no more communication is expected this way
+    def handle_write_event(self, ts):
+        try:
+            self.write_pending()
+        except IOError:
+            return False
+        if self.paused_history is not None and not self.is_queue_full():
+            self.resume_history()
+        if self.is_done():
+            return False
     def close(self):
+        if self.realtime_buffer is not None:
+            self.realtime_buffer.close()
         self.sock_file.close()
+        # a history dump abandoned by the client (from db or from
+        # RecentLogs) never reaches notify_history_processed(): do not
+        # wait for next records of our streams to leave the hub.
+        self.hub.removeHandler(self)
+        self.recent_history = None
+        if self.paused_history is not None:
+            # let the blocking thread end this history dump
+            self.resume_history()
+
+# Old logs and logs of forgotten devices are deleted by the logs
+# writer thread (see prune_db_logs()). Then old logs are archived,
+# and partitions not indexed yet are indexed, by the blocking thread
+# (see archive_db_logs() and index_db_logs()). We request this
+# periodically, and when a device is forgotten. If the work could not
+# be completed at once, we request it again after
+# LOGS_PRUNE_RETRY_DELAY seconds.
+LOGS_PRUNE_PERIOD       = 3600
+LOGS_PRUNE_RETRY_DELAY  = 1
+EV_LOGS_PRUNE           = 0
 
 class LogsManager(object):
-    def __init__(self, db, tcp_server, blocking, ev_loop):
+    def __init__(self, db, tcp_server, blocking, writer, ev_loop):
         self.db = db
         self.blocking = blocking
-        self.hub = LogsHub()
-        self.hub.addHandler(LogsToDBHandler(db))
-        tcp_server.register_listener_class(
-                    req_id = Requests.REQ_DUMP_LOGS,
-                    cls = LogsToSocketHandler,
-                    db = self.db,
-                    hub = self.hub,
-                    blocking = self.blocking)
+        self.writer = writer
+        self.ev_loop = ev_loop
+        self.pruning = False
+        self.prune_again = False
+        ev_loop.plan_event(
+            ts = time(),
+            target = self,
+            repeat_delay = LOGS_PRUNE_PERIOD,
+            ev_type = EV_LOGS_PRUNE
+        )
+        self.registry = LogStreamsRegistry(db)
+        self.hub = LogsHub(self.registry)
+        self.hub.join_event_loop(ev_loop)
+        self.db_handler = LogsToDBHandler(db, writer, self.hub, ev_loop)
+        self.hub.addHandler(self.db_handler)
+        for req_id, ack in ((Requests.REQ_DUMP_LOGS, False),
+                            (Requests.REQ_DUMP_LOGS_BATCHED, True)):
+            tcp_server.register_listener_class(
+                        req_id = req_id,
+                        cls = LogsToSocketHandler,
+                        db = self.db,
+                        db_handler = self.db_handler,
+                        hub = self.hub,
+                        blocking = self.blocking,
+                        ev_loop = ev_loop,
+                        ack = ack)
         tcp_server.register_listener_class(
                     req_id = Requests.REQ_NEW_INCOMING_LOGS,
                     cls = LogsStreamListener,
-                    db = self.db,
+                    registry = self.registry,
                     hub = self.hub)
-        self.netconsole = NetconsoleListener(self.db, self.hub, WALT_SERVER_NETCONSOLE_PORT)
+        tcp_server.register_listener_class(
+                    req_id = Requests.REQ_MUX_INCOMING_LOGS,
+                    cls = LogsMuxListener,
+                    registry = self.registry,
+                    hub = self.hub)
+        self.netconsole = NetconsoleListener(self.registry, self.hub,
+                                             WALT_SERVER_NETCONSOLE_PORT)
         self.netconsole.join_event_loop(ev_loop)
 
     def forget_device(self, device_name):
         device_info = self.db.select_unique('devices', name=device_name)
+        for stream_id in self.registry.forget_device(device_info.mac):
+            self.hub.recent.forget(stream_id)
+        self.hub.reset_streams_info()
         self.netconsole.forget_ip(device_info.ip)
+        # logs of this device will be deleted in the background,
+        # once its pending log records have reached the db
+        self.db_handler.flush_then(lambda result: self.plan_prune_logs(0))
+
+    def plan_prune_logs(self, delay):
+        self.ev_loop.plan_event(
+            ts = time() + delay,
+            target = self,
+            ev_type = EV_LOGS_PRUNE
+        )
+
+    def handle_planned_event(self, ev_type):
+        assert(ev_type == EV_LOGS_PRUNE)
+        if self.pruning:
+            self.prune_again = True
+            return
+        self.pruning = True
+        self.writer.prune_logs(self.logs_pruned)
+
+    # the result is a tuple (incomplete, limits), where limits gives
+    # the date before which logs of a stream were deleted, for each
+    # stream whose pruning is complete.
+    # note: if a task failed, its result is an exception
+    def logs_pruned(self, result):
+        incomplete = False
+        if isinstance(result, tuple):
+            incomplete, limits = result
+            for stream_id, before in limits.items():
+                self.hub.recent.forget(stream_id, before)
+            if not incomplete:
+                # continue with the tasks of the blocking thread
+                self.blocking.archive_logs(self.logs_maintained)
+                return
+        self.logs_maintained(incomplete)
+
+    def logs_maintained(self, incomplete):
+        self.pruning = False
+        if incomplete is True or self.prune_again:
+            self.prune_again = False
+            self.plan_prune_logs(LOGS_PRUNE_RETRY_DELAY)
+
+    def rename_device(self):
+        # sender names of log streams have changed
+        self.registry.reload_devices()
+        self.hub.reset_streams_info()
+
+    def device_updated(self, mac, ip):
+        if self.registry.device_updated(mac, ip):
+            self.hub.reset_streams_info()
+
+    def cleanup(self):
+        self.db_handler.cleanup()
 
     # Look for a checkpoint. Return a tuple.
     # If the result conforms to 'expected', return (True, <checkpoint_found_or_none>)
@@ -0,0 +1,166 @@
+import gzip, io, os, re
+from datetime import datetime, timedelta
+from heapq import merge
+from operator import itemgetter
+from walt.server import conf
+
+# Logs older than a given number of days may be moved from the
+# database to compressed files, by setting in section "logs" of
+# server.conf:
+# "archive": { "after-days": 30 }
+# Daily partitions of the logs table are archived one at a time by the
+# blocking thread: their records are written, sorted by timestamp, to
+# chunk files of at most LOGS_ARCHIVE_CHUNK_RECORDS records, then the
+# chunks are indexed in table logs_archive (day, time range and stream
+# ids of each chunk), and the partition is dropped.
+# History queries read the matching chunks transparently (see
+# iter_archived_logs()), and the per-minute counts of table
+# logs_counts are kept, thus approximate counts are unchanged.
+LOGS_ARCHIVE = ((conf or {}).get('logs', {})).get('archive', {})
+LOGS_ARCHIVE_PATH = '/var/lib/walt/logs-archive'
+LOGS_ARCHIVE_CHUNK_NAME = '%(partition)s-%(index)04d.gz'
+LOGS_ARCHIVE_CHUNK_RECORDS = 100000
+LOGS_ARCHIVE_FETCH_SIZE = 4000
+LOGS_ARCHIVE_COMPRESS_LEVEL = 6
+
+# one record per line: <stream_id> TAB <timestamp> TAB <line>
+# where timestamp is the number of microseconds since EPOCH, and
+# backslashes, tabs and newlines of the log line are escaped.
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds = 1)
+ARCHIVE_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r' })
+ARCHIVE_UNESCAPES = { '\\': '\\', 't': '\t', 'n': '\n', 'r': '\r' }
+ARCHIVE_ESCAPED_CHAR = re.compile(r'\\(.)')
+
+def unescape_char(m):
+    return ARCHIVE_UNESCAPES[m.group(1)]
+
+def get_chunk_path(name):
+    return os.path.join(LOGS_ARCHIVE_PATH, name)
+
+class ArchiveChunkWriter(object):
+    def __init__(self, name):
+        self.name = name
+        self.num_records = 0
+        self.stream_ids = set()
+        self.min_ts, self.max_ts = None, None
+        self.raw = open(get_chunk_path(name), 'wb')
+        self.f = io.TextIOWrapper(
+                    gzip.GzipFile(fileobj = self.raw, mode = 'wb',
+                                  compresslevel = LOGS_ARCHIVE_COMPRESS_LEVEL),
+                    encoding = 'utf-8', newline = '\n')
+    def write(self, stream_id, timestamp, line):
+        if self.min_ts is None:
+            self.min_ts = timestamp
+        self.max_ts = timestamp
+        self.stream_ids.add(stream_id)
+        self.f.write('%d\t%d\t%s\n' % (stream_id, (timestamp - EPOCH) // MICROSECOND,
+                                       line.translate(ARCHIVE_ESCAPES)))
+        self.num_records += 1
+    def close(self):
+        self.f.close()  # note: this does not close self.raw
+        # the chunk must be on disk before the partition is dropped
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+
+def read_chunk(name):
+    with gzip.open(get_chunk_path(name), 'rt',
+                   encoding = 'utf-8', newline = '\n') as f:
+        for row in f:
+            stream_id, timestamp, line = row[:-1].split('\t', 2)
+            if '\\' in line:
+                line = ARCHIVE_ESCAPED_CHAR.sub(unescape_char, line)
+            yield int(stream_id), EPOCH + timedelta(microseconds = int(timestamp)), line
+
+def remove_chunks(names):
+    for name in names:
+        try:
+            os.remove(get_chunk_path(name))
+        except FileNotFoundError:
+            pass
+
+# Move the logs of a daily partition to the archive.
+def archive_logs_partition(db, partition, day):
+    os.makedirs(LOGS_ARCHIVE_PATH, exist_ok = True)
+    # this day may have been archived already, if late records of this
+    # day were received afterwards (see db.ensure_logs_partitions())
+    archived = set(db.get_archived_logs_chunk_names(day))
+    # remove chunks left by an interrupted run
+    prefix = partition + '-'
+    remove_chunks(name for name in os.listdir(LOGS_ARCHIVE_PATH) \
+                        if name.startswith(prefix) and name not in archived)
+    chunks, writer = [], None
+    cursor_name = db.create_server_cursor()
+    cursor = db.get_partition_logs(cursor_name, partition)
+    while True:
+        records = cursor.fetchmany(LOGS_ARCHIVE_FETCH_SIZE)
+        if len(records) == 0:
+            break
+        for stream_id, timestamp, line in records:
+            if writer is None or writer.num_records == LOGS_ARCHIVE_CHUNK_RECORDS:
+                if writer is not None:
+                    writer.close()
+                writer = ArchiveChunkWriter(LOGS_ARCHIVE_CHUNK_NAME % \
+                            dict(partition = partition,
+                                 index = len(archived) + len(chunks)))
+                chunks.append(writer)
+            writer.write(stream_id, timestamp, line)
+    if writer is not None:
+        writer.close()
+    db.delete_server_cursor(cursor_name)
+    db.record_archived_logs_partition(partition, day, chunks)
+
+# Remove archived logs older than the given datetime.
+def drop_archived_logs(db, before):
+    remove_chunks(db.drop_archived_logs_chunks(before))
+
+# Iterate over archived log records, with the same parameters as
+# ServerDB.get_logs_page(). chunks must be obtained by calling
+# ServerDB.get_archived_logs_chunks() with these parameters.
+# Records are yielded in timestamp order, as
+# (stream_id, timestamp, line) tuples.
+# A day archived again (late records, see archive_logs_partition())
+# has chunks overlapping those archived before: chunks overlapping
+# in time are merged (each one is sorted), others are read in turn,
+# thus we do not open all chunks of a long history at once.
+def iter_archived_logs(chunks, history=(None,None), stream_ids=None,
+                       logline_regexp=None, **kwargs):
+    start, end = history
+    if stream_ids is not None:
+        stream_ids = set(stream_ids)
+    if logline_regexp:
+        logline_regexp = re.compile(logline_regexp)
+    for group in group_overlapping_chunks(chunks):
+        # same order as the records of the db (see LOGS_ORDERING)
+        yield from merge(*(iter_chunk_logs(chunk, start, end, stream_ids,
+                                           logline_regexp) \
+                           for chunk in group),
+                         key = itemgetter(1, 0))
+
+# chunks are sorted by min_ts
+def group_overlapping_chunks(chunks):
+    group, group_max_ts = [], None
+    for chunk in chunks:
+        if len(group) > 0 and chunk.min_ts > group_max_ts:
+            yield group
+            group = []
+        if len(group) == 0 or chunk.max_ts > group_max_ts:
+            group_max_ts = chunk.max_ts
+        group.append(chunk)
+    if len(group) > 0:
+        yield group
+
+def iter_chunk_logs(chunk, start, end, stream_ids, logline_regexp):
+    for record in read_chunk(chunk.name):
+        stream_id, timestamp, line = record
+        if start and timestamp <= start:
+            continue
+        if end and timestamp >= end:
+            return  # next records of this chunk are more recent
+        if stream_ids is not None and stream_id not in stream_ids:
+            continue
+        if logline_regexp and logline_regexp.search(line) is None:
+            continue
+        yield record
@@ -0,0 +1,28 @@
+from walt.common.thread import RPCThreadConnector
+
+# Batches of log records are not sent through the rpc pipe: it would
+# block the main thread when the writer thread is busy and the pipe
+# is full. We share a queue with the writer thread instead.
+class LogsWriterManager(RPCThreadConnector):
+    def connect(self, writer_thread):
+        RPCThreadConnector.connect(self, writer_thread.main)
+        self.batches = writer_thread.batches
+
+    def insert_logs(self, records, result_cb):
+        self.batches.append(records)
+        self.m_async.write_batch().then(result_cb)
+
+    # call result_cb when batches queued up to now are committed
+    def wait_pending_writes(self, result_cb):
+        self.m_async.wait_pending_writes().then(result_cb)
+
+    def prune_logs(self, result_cb):
+        self.m_async.prune_logs().then(result_cb)
+
+    # batches not yet written by the writer thread (at shutdown)
+    def pop_batches(self):
+        while len(self.batches) > 0:
+            try:
+                yield self.batches.popleft()
+            except IndexError:
+                break   # the writer thread was faster
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import re
 import pickle
 from walt.common.constants import WALT_SERVER_TCP_PORT
 from walt.common.devices.registry import get_device_info_from_mac
@@ -11,6 +10,7 @@ from walt.server.threads.main.images.image import format_image_fullname
 from walt.server.threads.main.images.manager import NodeImageManager
 from walt.server.threads.main.interactive import InteractionManager
 from walt.server.threads.main.logs import LogsManager
+from walt.server.threads.main.logswriter import LogsWriterManager
 from walt.server.threads.main.mydocker import DockerClient
 from walt.server.threads.main.network.dhcpd import DHCPServer
 from walt.server.threads.main.nodes.manager import NodesManager
@@ -30,12 +30,14 @@ class Server(object):
         self.db = ServerDB()
         self.docker = DockerClient()
         self.blocking = BlockingTasksManager()
+        self.logs_writer = LogsWriterManager()
         self.devices = DevicesManager(self.db)
         self.topology = TopologyManager(self.devices, self.add_or_update_device)
         self.dhcpd = DHCPServer(self.db)
         self.images = NodeImageManager(self.db, self.blocking, self.dhcpd, self.docker)
         self.tcp_server = TCPServer(WALT_SERVER_TCP_PORT)
-        self.logs = LogsManager(self.db, self.tcp_server, self.blocking, self.ev_loop)
+        self.logs = LogsManager(self.db, self.tcp_server, self.blocking,
+                                self.logs_writer, self.ev_loop)
         self.interaction = InteractionManager(\
                         self.tcp_server, self.ev_loop)
         self.transfer = TransferManager(\
@@ -54,6 +56,8 @@ class Server(object):
     def prepare(self):
         self.tcp_server.join_event_loop(self.ev_loop)
         self.db.plan_auto_commit(self.ev_loop)
+        self.db.commit_stats.join_event_loop(self.ev_loop)
+        self.db.plan_logs_maintenance(self.ev_loop)
         # ensure the dhcp server is running,
         # otherwise the switches may have ip addresses
         # outside the WalT network, and we will not be able
@@ -74,6 +78,7 @@ class Server(object):
 
     def cleanup(self):
         APISession.cleanup_all()
+        self.logs.cleanup()
         self.images.cleanup()
         self.nodes.cleanup()
 
@@ -103,6 +108,7 @@ class Server(object):
         kwargs.update(**info)
         new_equipment = self.devices.add_or_update(
                     ip = ip, mac = mac, **kwargs)
+        self.logs.device_updated(mac, ip)
         if new_equipment and info.get('type') == 'node':
             # this is a walt node
             self.nodes.register_node(   mac = mac,
@@ -113,6 +119,7 @@ class Server(object):
 
     def rename_device(self, requester, old_name, new_name):
         self.devices.rename(requester, old_name, new_name)
+        self.logs.rename_device()
         self.dhcpd.update()
         tftp.update(self.db)
 
@@ -153,25 +160,24 @@ class Server(object):
         self.nodes.forget_vnode(name)
         self.forget_device(name)
 
-    def count_logs(self, history, streams = None, senders = None, **kwargs):
-        unpickled_history = (pickle.loads(e) if e else None for e in history)
-        if streams:
-            # compute streams ids whose name match the regular expression
-            stream_ids = []
-            streams_re = re.compile(streams)
-            for row in self.db.get_logstream_ids(senders):
-                matches = streams_re.findall(row.name)
-                if len(matches) > 0:
-                    stream_ids.append(str(row.id))
-            if len(stream_ids) == 0:
-                return 0    # no streams => no logs
-            # we can release the constraint on senders since we restrict to
-            # their logstreams (cf. stream_ids variable we just computed)
-            senders = None
-        else:
-            stream_ids = None
+    def count_logs(self, task, history, streams = None, senders = None,
+                   logline_regexp = None, **kwargs):
+        unpickled_history = tuple(pickle.loads(e) if e else None for e in history)
+        # compute ids of the log streams of these senders whose name
+        # match the regular expression
+        stream_ids = self.db.get_matching_logstream_ids(senders, streams)
+        if len(stream_ids) == 0:
+            return 0    # no streams => no logs
+        if logline_regexp:
+            # matching lines have to be read and counted, which may
+            # take long: let the blocking thread do it.
+            task.set_async()
+            self.blocking.count_logs(task.return_result,
+                                     history = unpickled_history,
+                                     stream_ids = stream_ids,
+                                     logline_regexp = logline_regexp)
+            return
         return self.db.count_logs(history = unpickled_history,
-                                  senders = senders,
                                   stream_ids = stream_ids,
                                   **kwargs)
 
@@ -10,12 +10,14 @@ class ServerMainThread(EvThread):
         self.ui = UIManager()
         self.server = Server(self, self.ui)
         self.blocking = self.server.blocking
+        self.logs_writer = self.server.logs_writer
         self.hub = HubRPCThreadConnector(self.server)
 
     def prepare(self):
         self.server.prepare()
         self.register_listener(self.hub)
         self.register_listener(self.blocking)
+        self.register_listener(self.logs_writer)
         setup(self.ui)
         self.notify_systemd()
         self.server.ui.set_status('Ready.')
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from itertools import takewhile
+from time import time
 import pickle
 import re
 
@@ -171,3 +172,21 @@ def format_node_models_list(node_models):
         return regex_result
     else:
         return simple_result
+
+# Statistics printed periodically, then reset.
+# Subclasses must define LABEL, and methods reset(), is_empty()
+# and __str__().
+class PeriodicStats(object):
+    PERIOD = 300
+    def __init__(self):
+        self.reset()
+    def join_event_loop(self, ev_loop):
+        ev_loop.plan_event(
+            ts = time() + self.PERIOD,
+            target = self,
+            repeat_delay = self.PERIOD
+        )
+    def handle_planned_event(self):
+        if not self.is_empty():
+            print('%s (last %ds): %s' % (self.LABEL, self.PERIOD, self))
+        self.reset()